@@ -1,8 +1,15 @@
 # coding: utf-8
+import copy
+import json
+import os
+import re
 from boto3 import Session
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
 from ecs.scheduled_tasks import ScheduledTask
 from botocore.exceptions import ClientError
-from time import sleep
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
 from random import randint
 
 
@@ -18,12 +25,214 @@ class TaskDefinitionNotFoundException(Exception):
     pass
 
 
+class Throttle(object):
+    """
+    API call budget shared by every AwsUtils of a deploy.
+    Limits the number of concurrent calls, and when one call is throttled every caller backs off together.
+    """
+    def __init__(self, concurrency: int):
+        self.semaphore = BoundedSemaphore(concurrency)
+        self.lock = Lock()
+        self.backoff_until = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            wait = self.backoff_until - time()
+        if wait > 0:
+            sleep(wait)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.semaphore.release()
+        return False
+
+    def backoff(self, seconds: int):
+        with self.lock:
+            self.backoff_until = max(self.backoff_until, time() + seconds)
+
+
+class ThrottledClient(object):
+    """
+    boto3 client whose api calls all take the Throttle, so updates, deletes, events and lambda calls share the
+    budget of the describes
+    """
+    # clientのapiを呼ばないメソッド
+    unthrottled_methods = ('get_waiter', 'get_paginator', 'can_paginate')
+
+    def __init__(self, client, throttle: Throttle):
+        self.client = client
+        self.throttle = throttle
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name in self.unthrottled_methods:
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.throttle:
+                return attribute(*args, **kwargs)
+        return call
+
+
+def poll_intervals(timeout: float, initial: float=1, maximum: float=15, expected: float=None):
+    """
+    Seconds to sleep between polls: start fast and back off up to `maximum`.
+    With the expected duration, most of it is polled every `maximum` seconds and the back off restarts from there.
+    No sleep is longer than `maximum`, so failed tasks and service events are still seen while waiting.
+    Ends when the total reaches `timeout`.
+    """
+    elapsed = 0
+    if expected is not None and expected * 0.8 > initial:
+        seeded = min(expected * 0.8, timeout)
+        while elapsed < seeded:
+            interval = min(maximum, seeded - elapsed)
+            yield interval
+            elapsed += interval
+    delay = initial
+    while elapsed < timeout:
+        interval = min(delay, maximum, timeout - elapsed)
+        yield interval
+        elapsed += interval
+        delay = delay * 1.5
+
+
+class LambdaPolicyCache(object):
+    """
+    Statement ids of the target Lambda function policies, shared by every AwsUtils of a deploy.
+    Each policy is read once per run, and writers to the same function are serialized.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.function_locks = {}
+        self.statement_ids = {}
+
+    def function_lock(self, function_name: str) -> Lock:
+        with self.lock:
+            return self.function_locks.setdefault(function_name, Lock())
+
+
+class WarmState(object):
+    """
+    Clients, cluster lists and task definitions kept by a long running agent and shared by all its deploys.
+    boto3 clients are thread safe, and a task definition revision never changes after it is registered.
+    Services and event rules are not indexed: other deploys and autoscaling change them between jobs, and a
+    listed ARN set does not show those changes, so every job lists and describes them again.
+    """
+    def __init__(self, cluster_list_ttl: int=300):
+        self.lock = Lock()
+        self.clients = {}
+        self.task_definitions = {}
+        self.cluster_lists = {}
+        self.cluster_list_ttl = cluster_list_ttl
+
+
+# agentで動いている時だけ使う
+warm_state = None
+
+
+def keep_warm(cluster_list_ttl: int=300) -> WarmState:
+    global warm_state
+    if warm_state is None:
+        warm_state = WarmState(cluster_list_ttl=cluster_list_ttl)
+    return warm_state
+
+
+role_credentials = {}
+role_credentials_lock = Lock()
+
+
+def get_role_credentials(access_key, secret_key, region, role_arn: str,
+                         session_name: str='aws-ecs-deploy') -> RefreshableCredentials:
+    """
+    Credentials of the role, for deploying to another account.
+    The role is assumed again before the temporary credentials expire, so a deploy can run longer than the role
+    session. The credentials are shared by every AwsUtils of the role.
+    """
+    key = (access_key, secret_key, region, role_arn)
+    with role_credentials_lock:
+        credentials = role_credentials.get(key)
+        if credentials is not None:
+            return credentials
+        sts = Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)\
+            .client('sts')
+
+        def refresh() -> dict:
+            response = sts.assume_role(RoleArn=role_arn, RoleSessionName=session_name)['Credentials']
+            return {
+                'access_key': response['AccessKeyId'],
+                'secret_key': response['SecretAccessKey'],
+                'token': response['SessionToken'],
+                'expiry_time': response['Expiration'].isoformat()
+            }
+        credentials = RefreshableCredentials.create_from_metadata(metadata=refresh(), refresh_using=refresh,
+                                                                  method='sts-assume-role')
+        role_credentials[key] = credentials
+        return credentials
+
+
 class AwsUtils(object):
-    def __init__(self, access_key, secret_key, region='us-east-1'):
-        session = Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
-        self.client = session.client('ecs')
-        self.cloudwatch_event = session.client('events')
-        self.aws_lambda = session.client('lambda')
+    def __init__(self, access_key, secret_key, region='us-east-1', throttle: Throttle=None,
+                 lambda_policy_cache: LambdaPolicyCache=None, role_arn: str=None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        # 他のアカウントには、このroleを引き受けてデプロイする
+        self.role_arn = role_arn
+        self.region = region
+        if throttle is None:
+            throttle = Throttle(concurrency=1)
+        self.throttle = throttle
+        if lambda_policy_cache is None:
+            lambda_policy_cache = LambdaPolicyCache()
+        self.lambda_policy_cache = lambda_policy_cache
+        # clientの作成は遅いので、使うときに作る
+        self.session_lock = Lock()
+        self.session = None
+        self.clients = {}
+
+    def _warm_key(self) -> tuple:
+        # 引数で渡していない認証情報は環境変数から読まれる
+        environ = tuple(sorted([(k, v) for k, v in os.environ.items() if k.startswith('AWS_')]))
+        return self.access_key, self.secret_key, self.role_arn, self.region, environ
+
+    def _new_session(self) -> Session:
+        if self.role_arn is None:
+            return Session(aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key,
+                           region_name=self.region)
+        botocore_session = get_session()
+        botocore_session._credentials = get_role_credentials(access_key=self.access_key, secret_key=self.secret_key,
+                                                             region=self.region, role_arn=self.role_arn)
+        return Session(botocore_session=botocore_session, region_name=self.region)
+
+    def _get_client(self, service_name: str):
+        if warm_state is not None:
+            with warm_state.lock:
+                key = self._warm_key() + (service_name,)
+                client = warm_state.clients.get(key)
+                if client is None:
+                    client = self._new_session().client(service_name)
+                    warm_state.clients[key] = client
+            return client
+        with self.session_lock:
+            client = self.clients.get(service_name)
+            if client is None:
+                if self.session is None:
+                    self.session = self._new_session()
+                client = self.session.client(service_name)
+                self.clients[service_name] = client
+        return client
+
+    @property
+    def client(self):
+        return ThrottledClient(self._get_client('ecs'), self.throttle)
+
+    @property
+    def cloudwatch_event(self):
+        return ThrottledClient(self._get_client('events'), self.throttle)
+
+    @property
+    def aws_lambda(self):
+        return ThrottledClient(self._get_client('lambda'), self.throttle)
 
     def describe_cluster(self, cluster):
         """
@@ -37,7 +246,26 @@ class AwsUtils(object):
             raise Exception("Cluster '%s' is %s" % (cluster, failures[0].get('reason')))
         return response
 
+    def find_clusters(self, cluster_list: list) -> list:
+        """
+        Describe the clusters 100 at a time. Clusters not found or inactive are left out.
+        :param cluster_list: cluster names
+        :return: cluster arns
+        """
+        cluster_arns = []
+        for i in range(0, len(cluster_list), 100):
+            response = self.client.describe_clusters(clusters=cluster_list[i:i + 100])
+            cluster_arns.extend([x['clusterArn'] for x in response['clusters'] if x.get('status', 'ACTIVE') == 'ACTIVE'])
+        return cluster_arns
+
     def describe_task_definition(self, name):
+        # リビジョン付きのarnなら内容は変わらない
+        is_revision = warm_state is not None and re.match(r'^arn:.+:task-definition/.+:\d+$', name) is not None
+        if is_revision:
+            with warm_state.lock:
+                task_definition = warm_state.task_definitions.get(name)
+            if task_definition is not None:
+                return copy.deepcopy(task_definition)
         retry_count = 0
         while True:
             try:
@@ -53,12 +281,22 @@ class AwsUtils(object):
                 else:
                     raise
             break
-        return response.get('taskDefinition')
+        task_definition = response.get('taskDefinition')
+        if is_revision and task_definition is not None:
+            with warm_state.lock:
+                warm_state.task_definitions[name] = copy.deepcopy(task_definition)
+        return task_definition
 
     def delete_service(self, cluster, service_name):
         self.client.update_service(cluster=cluster, service=service_name, desiredCount=0)
-        waiter = self.client.get_waiter('services_stable')
-        waiter.wait(cluster=cluster, services=[service_name])
+        # タスクがなくなるまで待つ
+        intervals = poll_intervals(timeout=600)
+        while self.describe_service(cluster=cluster, service=service_name)['runningCount'] > 0:
+            interval = next(intervals, None)
+            if interval is None:
+                raise Exception("Service '{service_name}' tasks did not stop in cluster '{cluster}'"
+                                .format(service_name=service_name, cluster=cluster))
+            sleep(interval)
 
         self.client.delete_service(cluster=cluster, service=service_name)
 
@@ -70,6 +308,30 @@ class AwsUtils(object):
             service_arn_list.extend(response['serviceArns'])
         return service_arn_list
 
+    def get_container_instance_resources(self, cluster: str) -> dict:
+        """
+        Sum of the registered and remaining resources of the active container instances in the cluster
+        :param cluster: the cluster name
+        :return: {'registered': {'CPU': int, 'MEMORY': int}, 'remaining': {'CPU': int, 'MEMORY': int}}
+        """
+        response = self.client.list_container_instances(cluster=cluster, status='ACTIVE')
+        container_instance_arns = response['containerInstanceArns']
+        while 'nextToken' in response:
+            response = self.client.list_container_instances(
+                cluster=cluster, status='ACTIVE', nextToken=response['nextToken'])
+            container_instance_arns.extend(response['containerInstanceArns'])
+        resources = {'registered': {'CPU': 0, 'MEMORY': 0}, 'remaining': {'CPU': 0, 'MEMORY': 0}}
+        while len(container_instance_arns) > 0:
+            response = self.client.describe_container_instances(
+                cluster=cluster, containerInstances=container_instance_arns[:100])
+            container_instance_arns = container_instance_arns[100:]
+            for container_instance in response['containerInstances']:
+                for key, field in (('registered', 'registeredResources'), ('remaining', 'remainingResources')):
+                    for resource in container_instance.get(field, []):
+                        if resource['name'] in ('CPU', 'MEMORY'):
+                            resources[key][resource['name']] += resource['integerValue']
+        return resources
+
     def describe_service(self, cluster, service):
         """
         Describe the specified service or raise an Exception if service does not exists in cluster
@@ -77,7 +339,20 @@ class AwsUtils(object):
         :param service: the service name
         :return: the response or raise an Exception
         """
-        response = self.client.describe_services(cluster=cluster, services=[service])
+        retry_count = 0
+        while True:
+            try:
+                response = self.client.describe_services(cluster=cluster, services=[service])
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ThrottlingException':
+                    if retry_count > 6:
+                        raise
+                    retry_count = retry_count + 1
+                    self.throttle.backoff(randint(3, 10))
+                    continue
+                else:
+                    raise
+            break
         failures = response.get('failures')
         if failures:
             raise EcsServiceNotFoundException("Service '{service}' failure in cluster '{cluster}'.\nfailures:{failures}"
@@ -99,7 +374,7 @@ class AwsUtils(object):
         """
         result = {"services": [], "failures": []}
         while len(service_list) > 0:
-            response = self.client.describe_services(cluster=cluster, services=service_list[:10])
+            response = self.client.describe_services(cluster=cluster, services=service_list[:10], include=['TAGS'])
             if len(response['services']) > 0:
                 result['services'].extend(response['services'])
             if len(response['failures']) > 0:
@@ -138,10 +413,26 @@ class AwsUtils(object):
                 services.append(inactive_dup_services[0])
         return services
 
+    def find_services(self, cluster: str, service_list: list) -> dict:
+        """
+        Describe the services 10 at a time. Services not found are left out.
+        :param cluster: the cluster name
+        :param service_list: service names
+        :return: service name -> the description
+        """
+        services = {}
+        for i in range(0, len(service_list), 10):
+            response = self.client.describe_services(cluster=cluster, services=service_list[i:i + 10])
+            for res_service in response['services']:
+                # 同名のサービスがあればACTIVEを返しておく
+                if res_service['serviceName'] not in services or res_service['status'] == 'ACTIVE':
+                    services[res_service['serviceName']] = res_service
+        return services
+
     def create_service(self, cluster, service, task_definition, desired_count,
                        maximum_percent, minimum_healthy_percent, distinct_instance,
                        placement_strategy, placement_constraints, load_balancers,
-                       network_configuration, service_registries):
+                       network_configuration, service_registries, tags=None):
         """
         Create service
         :param cluster: the cluster name
@@ -156,6 +447,7 @@ class AwsUtils(object):
         :param load_balancers: list LoadBalancers
         :param network_configuration: dict networkConfiguration
         :param service_registries: list serviceRegistries
+        :param tags: list tags
         :return: the response or raise an Exception
         """
         parameters = {
@@ -188,6 +480,8 @@ class AwsUtils(object):
             parameters.update({'networkConfiguration': network_configuration})
         if service_registries:
             parameters.update({'serviceRegistries': service_registries})
+        if tags:
+            parameters.update({'tags': tags})
 
         response = self.client.create_service(**parameters)
         failures = response.get('failures')
@@ -197,10 +491,11 @@ class AwsUtils(object):
 
         return response['service']
 
-    def register_task_definition(self, task_definition):
+    def register_task_definition(self, task_definition, tags=None):
         """
         Register the task definition contained in the file
         :param task_definition: the task definition
+        :param tags: list tags
         :return: the response or raise an Exception
         """
         parameters = {
@@ -218,6 +513,8 @@ class AwsUtils(object):
             parameters.update(
                 {'taskRoleArn': task_role_arn}
             )
+        if tags:
+            parameters.update({'tags': tags})
         retry_count = 0
         while True:
             try:
@@ -228,7 +525,7 @@ class AwsUtils(object):
                     if retry_count > 6:
                         raise
                     retry_count = retry_count + 1
-                    sleep(randint(3, 10))
+                    self.throttle.backoff(randint(3, 10))
                     continue
                 else:
                     raise
@@ -241,6 +538,7 @@ class AwsUtils(object):
 
     def deregister_task_definition(self, task_definition):
         retry_count = 0
+        response = None
         while True:
             try:
                 response = self.client.deregister_task_definition(taskDefinition=task_definition)
@@ -250,21 +548,51 @@ class AwsUtils(object):
                     if retry_count > 3:
                         break
                     retry_count = retry_count + 1
-                    sleep(3)
+                    self.throttle.backoff(3)
                     continue
                 else:
                     raise
             break
         return response
 
+    def list_task_definitions(self, family: str) -> list:
+        """
+        List ACTIVE task definition arns of the family, newest revision first
+        :param family: the task definition family
+        :return: list of task definition arn
+        """
+        parameters = {'familyPrefix': family, 'status': 'ACTIVE', 'sort': 'DESC'}
+        task_definition_arns = []
+        while True:
+            response = self.client.list_task_definitions(**parameters)
+            # familyPrefix is prefix match, so drop the other families
+            for arn in response['taskDefinitionArns']:
+                if arn.split('/')[-1].rsplit(':', 1)[0] == family:
+                    task_definition_arns.append(arn)
+            if 'nextToken' not in response:
+                break
+            parameters.update({'nextToken': response['nextToken']})
+        return task_definition_arns
+
     def update_service(
             self, cluster, service, task_definition=None,
-            maximum_percent=None, minimum_healthy_percent=None, desired_count=None, force_new_deployment=True
+            maximum_percent=None, minimum_healthy_percent=None, desired_count=None, force_new_deployment=True,
+            placement_strategy=None, placement_constraints=None
     ):
+        """
+        Update service
+        :param placement_strategy: placementStrategy. None keeps the current one, an empty list removes it
+        :param placement_constraints: placementConstraints. None keeps the current one, an empty list removes it
+        :return: the response or raise an Exception
+        """
         parameters = {
             'cluster': cluster,
             'service': service
         }
+        if placement_strategy is not None:
+            parameters.update({'placementStrategy': placement_strategy})
+        if placement_constraints is not None:
+            parameters.update({'placementConstraints': placement_constraints})
         if force_new_deployment:
             parameters.update({'forceNewDeployment': True})
         if desired_count is not None:
@@ -290,7 +618,7 @@ class AwsUtils(object):
                 if e.response['Error']['Code'] == 'ThrottlingException':
                     if retry > 5:
                         raise e
-                    sleep(3)
+                    self.throttle.backoff(3)
                     retry += 1
                     continue
                 elif e.response['Error']['Code'] == 'ServiceNotFoundException':
@@ -303,19 +631,6 @@ class AwsUtils(object):
                     raise e
         return res
 
-    def wait_for_stable(self, cluster_name: str, service_name: str, delay: int, max_attempts: int):
-        # Waiting for the service update is done
-        waiter = self.client.get_waiter('services_stable')
-        waiter.wait(
-            cluster=cluster_name,
-            services=[service_name],
-            WaiterConfig={
-                'Delay': delay,
-                'MaxAttempts': max_attempts
-            }
-        )
-        return self.describe_service(cluster=cluster_name, service=service_name)
-
     def create_scheduled_task(self, scheduled_task: ScheduledTask, description: str):
         res_p = self.cloudwatch_event.put_rule(
             Name=scheduled_task.family,
@@ -324,21 +639,73 @@ class AwsUtils(object):
             State=scheduled_task.state.value
         )
         event_arn = res_p['RuleArn']
+        if scheduled_task.is_ecs_target():
+            self.cloudwatch_event.put_targets(Rule=scheduled_task.name, Targets=[self.__ecs_target(scheduled_task)])
+            return
         targets = [{'Id': scheduled_task.name, 'Arn': scheduled_task.target_lambda_arn}]
         self.cloudwatch_event.put_targets(Rule=scheduled_task.name, Targets=targets)
+        with self.lambda_policy_cache.function_lock(scheduled_task.target_lambda_arn):
+            statement_ids = self.__get_policy_statement_ids(scheduled_task.target_lambda_arn)
+            if scheduled_task.family in statement_ids:
+                return
+            try:
+                self.aws_lambda.add_permission(
+                    FunctionName=scheduled_task.target_lambda_arn,
+                    StatementId=scheduled_task.family,
+                    Action="lambda:*",
+                    Principal="events.amazonaws.com",
+                    SourceArn=event_arn
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ResourceConflictException':
+                    pass
+                else:
+                    raise
+            statement_ids.add(scheduled_task.family)
+
+    @staticmethod
+    def __ecs_target(scheduled_task: ScheduledTask) -> dict:
+        # task definition arnと同じregion, accountのclusterなので、describe_clusterせずにarnを組み立てる
+        arn_prefix = scheduled_task.task_definition_arn.split(':task-definition/')[0]
+        ecs_parameters = {
+            'TaskDefinitionArn': scheduled_task.task_definition_arn,
+            'TaskCount': scheduled_task.task_environment.task_count
+        }
+        if scheduled_task.placement_strategy:
+            ecs_parameters.update({'PlacementStrategy': scheduled_task.placement_strategy})
+        if scheduled_task.placement_constraints:
+            ecs_parameters.update({'PlacementConstraints': scheduled_task.placement_constraints})
+        awsvpc_configuration = (scheduled_task.network_configuration or {}).get('awsvpcConfiguration')
+        if awsvpc_configuration:
+            # eventsのEcsParametersはキーが大文字で始まる
+            ecs_parameters.update({'NetworkConfiguration': {'awsvpcConfiguration': {
+                key[0].upper() + key[1:]: value for key, value in awsvpc_configuration.items()
+            }}})
+        return {
+            'Id': scheduled_task.name,
+            'Arn': '{prefix}:cluster/{cluster}'.format(prefix=arn_prefix,
+                                                       cluster=scheduled_task.task_environment.cluster_name),
+            'RoleArn': scheduled_task.events_role_arn,
+            'EcsParameters': ecs_parameters
+        }
+
+    def __get_policy_statement_ids(self, function_name: str) -> set:
+        # function_lockを取得して呼ぶこと
+        statement_ids = self.lambda_policy_cache.statement_ids.get(function_name)
+        if statement_ids is not None:
+            return statement_ids
         try:
-            self.aws_lambda.add_permission(
-                FunctionName=scheduled_task.target_lambda_arn,
-                StatementId=scheduled_task.family,
-                Action="lambda:*",
-                Principal="events.amazonaws.com",
-                SourceArn=event_arn
-            )
+            response = self.aws_lambda.get_policy(FunctionName=function_name)
+            policy = json.loads(response['Policy'])
+            statement_ids = set([x.get('Sid') for x in policy.get('Statement', [])])
         except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceConflictException':
-                pass
+            # ポリシーがまだない
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                statement_ids = set()
             else:
                 raise
+        self.lambda_policy_cache.statement_ids[function_name] = statement_ids
+        return statement_ids
 
     def list_cloudwatch_event_rules(self) -> list:
         response = self.cloudwatch_event.list_rules()
@@ -349,19 +716,27 @@ class AwsUtils(object):
         return cloud_watch_event_rules
 
     def delete_scheduled_task(self, name: str, target_arn: str):
-        try:
-            self.aws_lambda.remove_permission(
-                FunctionName=target_arn,
-                StatementId=name
-            )
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                pass
-            else:
-                raise
+        if target_arn is not None:
+            self.remove_permission(name=name, target_arn=target_arn)
         self.cloudwatch_event.remove_targets(Rule=name, Ids=[name])
         self.cloudwatch_event.delete_rule(Name=name)
 
+    def remove_permission(self, name: str, target_arn: str):
+        with self.lambda_policy_cache.function_lock(target_arn):
+            try:
+                self.aws_lambda.remove_permission(
+                    FunctionName=target_arn,
+                    StatementId=name
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                    pass
+                else:
+                    raise
+            statement_ids = self.lambda_policy_cache.statement_ids.get(target_arn)
+            if statement_ids is not None:
+                statement_ids.discard(name)
+
     def describe_rule(self, name: str) -> dict:
         try:
             response = self.cloudwatch_event.describe_rule(Name=name)
@@ -388,11 +763,38 @@ class AwsUtils(object):
         self.client.stop_task(cluster=cluster, task=task_arn, reason='aws ecs deploy')
 
     def wait_for_task_stopped(self, cluster: str, tasks: list):
-        # Waiting for the service update is done
-        waiter = self.client.get_waiter('tasks_stopped')
-        waiter.wait(cluster=cluster, tasks=tasks)
+        intervals = poll_intervals(timeout=600, maximum=6)
+        running_tasks = list(tasks)
+        while True:
+            stopped = set()
+            for i in range(0, len(running_tasks), 100):
+                response = self.client.describe_tasks(cluster=cluster, tasks=running_tasks[i:i + 100])
+                stopped.update([x['taskArn'] for x in response['tasks'] if x['lastStatus'] == 'STOPPED'])
+                # 見つからないタスクは止まっている
+                stopped.update([x['arn'] for x in response.get('failures', []) if x.get('reason') == 'MISSING'])
+            running_tasks = [x for x in running_tasks if x not in stopped]
+            if len(running_tasks) == 0:
+                return
+            interval = next(intervals, None)
+            if interval is None:
+                raise Exception("Tasks did not stop in cluster '{cluster}'.\ntasks: {tasks}"
+                                .format(cluster=cluster, tasks=running_tasks))
+            sleep(interval)
 
     def list_clusters(self) -> list:
+        if warm_state is not None:
+            key = self._warm_key()
+            with warm_state.lock:
+                cached = warm_state.cluster_lists.get(key)
+            if cached is not None and time() - cached[0] < warm_state.cluster_list_ttl:
+                return list(cached[1])
+            cluster_arns = self._list_clusters()
+            with warm_state.lock:
+                warm_state.cluster_lists[key] = (time(), list(cluster_arns))
+            return cluster_arns
+        return self._list_clusters()
+
+    def _list_clusters(self) -> list:
         response = self.client.list_clusters()
         cluster_arns = response['clusterArns']
         while 'nextToken' in response:
@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+Startup time budget of the commands run by short CI jobs.
+
+    python benchmarks/startup.py
+
+Runs each command with `python -X importtime`, prints the import time, the wall time and the slowest imports,
+and exits 1 when a command imports more than its budget.
+"""
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (command, import time budget in ms)
+commands = [
+    (['test-templates', '--services-yaml', 'sample/services.yml', '--environment-yaml-dir', 'sample/conf'], 200),
+    (['service', '--test'], 60),
+]
+
+
+def parse_importtime(stderr: str) -> list:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        # 子のimportはインデントされる。トップレベルのみ集計する
+        if name[1:].startswith(' '):
+            continue
+        imports.append((int(cumulative_us), name.strip()))
+    return imports
+
+
+def main():
+    over_budget = False
+    for command, budget in commands:
+        start = time.time()
+        res = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.join(root, 'main.py')] + command,
+            cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        wall = (time.time() - start) * 1000
+        imports = parse_importtime(res.stderr)
+        import_ms = sum(x[0] for x in imports) / 1000
+        status = 'ok' if import_ms <= budget else 'OVER BUDGET'
+        if import_ms > budget or res.returncode != 0:
+            over_budget = True
+        print("{command}: import {import_ms:.0f}ms (budget {budget}ms), wall {wall:.0f}ms, exit {code} {status}"
+              .format(command=' '.join(command), import_ms=import_ms, budget=budget, wall=wall,
+                      code=res.returncode, status=status))
+        for cumulative_us, name in sorted(imports, reverse=True)[:5]:
+            print("    {ms:8.1f}ms {name}".format(ms=cumulative_us / 1000, name=name))
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+# coding: utf-8
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from threading import Lock
+
+
+class _SocketOutput(object):
+    """
+    stdout and stderr of a job, sent to the client as json lines
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = Lock()
+        self.is_closed = False
+
+    def send(self, message: dict):
+        with self.lock:
+            if self.is_closed:
+                return
+            try:
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except OSError:
+                # clientが切れてもデプロイは最後まで続ける
+                self.is_closed = True
+
+    def write(self, text: str) -> int:
+        if len(text) > 0:
+            self.send({'output': text})
+            if self.is_closed:
+                sys.__stdout__.write(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _StdoutProxy(object):
+    # loggingのhandlerはstreamを保持するので、jobごとのstdoutに流す
+    def write(self, text: str) -> int:
+        return sys.stdout.write(text)
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        output = _SocketOutput(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            output.send({'output': "x invalid request\n", 'exit': 1})
+            return
+        output.send({'exit': self.server.run_job(request, output)})
+
+
+class DeployAgentServer(socketserver.UnixStreamServer):
+    """
+    Runs the jobs submitted by `--agent-socket` clients one at a time.
+    A job is the command line of main.py, run in the working directory and with the environment variables of
+    the client. Jobs are not run concurrently because they share the working directory, the environment
+    variables and stdout of the process.
+    """
+    def __init__(self, socket_path: str, parse, run):
+        self.parse = parse
+        self.run = run
+        super().__init__(socket_path, _JobHandler)
+
+    def run_job(self, request: dict, output: _SocketOutput) -> int:
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        args = None
+        code = 0
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            with redirect_stdout(output), redirect_stderr(output):
+                # noinspection PyBroadException
+                try:
+                    args = self.parse(request['argv'])
+                    if args.command == 'agent':
+                        print("x the agent cannot run an agent.")
+                        return 1
+                    args.agent_socket = None
+                    self.run(args)
+                except SystemExit as e:
+                    if e.code is None:
+                        code = 0
+                    elif isinstance(e.code, int):
+                        code = e.code
+                    else:
+                        print(e.code)
+                        code = 1
+                except Exception:
+                    print(traceback.format_exc())
+                    code = 1
+        finally:
+            if args is not None:
+                _close_files(args)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+        return code
+
+
+def _close_files(args):
+    # agentは終了しないので、argparseが開いたファイルを閉じる
+    for value in vars(args).values():
+        for f in value if isinstance(value, list) else [value]:
+            if isinstance(f, io.IOBase):
+                f.close()
+
+
+def serve(socket_path: str, parse, run, cluster_list_ttl: int=300):
+    """
+    Keep boto3 clients, cluster lists, task definitions and compiled templates warm,
+    and run the jobs submitted to the unix socket. Services and event rules are read from ECS for every job.
+    :param parse: parses the command line of a job
+    :param run: runs the parsed command line
+    :param cluster_list_ttl: seconds to reuse the cluster list of a region
+    """
+    from aws import keep_warm
+    from ecs.utils import success, info
+    # boto3とデプロイのmoduleは起動時に読み込む
+    import ecs.deploy  # noqa: F401
+    keep_warm(cluster_list_ttl=cluster_list_ttl)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(_StdoutProxy())
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # 環境変数に認証情報が含まれるので本人だけ
+    umask = os.umask(0o177)
+    try:
+        server = DeployAgentServer(socket_path, parse=parse, run=run)
+    finally:
+        os.umask(umask)
+    success("Agent is listening on `{socket_path}`.".format(socket_path=socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        info("Agent stopped.")
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def submit(socket_path: str, argv: list) -> int:
+    """
+    Run the command line in the agent and print its output
+    :return: exit code of the job
+    """
+    request = {'argv': argv, 'cwd': os.getcwd(), 'environ': dict(os.environ)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                message = json.loads(line)
+                if 'output' in message:
+                    sys.stdout.write(message['output'])
+                    sys.stdout.flush()
+                if 'exit' in message:
+                    return message['exit']
+    print("x agent closed the connection before the job finished.")
+    return 1
@@ -0,0 +1,118 @@
+# coding: utf-8
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+
+from aws import EcsServiceNotFoundException
+from ecs.classes import ProcessMode, ProcessStatus
+from ecs.deploy import DeployProcess, service_stable, service_wait_timeout, service_wait_failed, \
+    service_wait_progress
+from ecs.stability import ServiceStabilityTracker, StableState
+from ecs.utils import error
+
+
+class AsyncTaskQueue(object):
+    """
+    Task queue with the same interface as `queue.Queue` used by DeployManager.
+    Jobs run on one asyncio event loop: AWS calls are offloaded to a bounded thread pool,
+    and waiting for stable is polled on the loop, so waiting services do not hold a thread.
+    """
+    def __init__(self, process: DeployProcess, executor_size: int, concurrency: int):
+        self.process = process
+        self.executor = ThreadPoolExecutor(max_workers=executor_size)
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.semaphore = None
+        self.concurrency = concurrency
+        self.lock = Lock()
+        self.futures = []
+        self.waiting_count = 0
+
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+
+    def put(self, item):
+        deploy, mode = item
+        with self.lock:
+            self.waiting_count += 1
+            future = asyncio.run_coroutine_threadsafe(self._run(deploy, mode), self.loop)
+            self.futures.append(future)
+
+    def qsize(self) -> int:
+        return self.waiting_count
+
+    @property
+    def unfinished_tasks(self) -> int:
+        with self.lock:
+            return len([x for x in self.futures if not x.done()])
+
+    def join(self):
+        while True:
+            with self.lock:
+                futures = self.futures
+                self.futures = []
+            if len(futures) == 0:
+                return
+            for future in futures:
+                future.result()
+
+    async def _run(self, deploy, mode):
+        if self.semaphore is None:
+            # event loopのthreadで作る
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            with self.lock:
+                self.waiting_count -= 1
+            # noinspection PyBroadException
+            try:
+                if mode == ProcessMode.waitForStable and deploy.status != ProcessStatus.error:
+                    started = time.time()
+                    await self._wait_for_stable(deploy)
+                    self.process.record_wait(deploy, started)
+                else:
+                    await self.loop.run_in_executor(None, self.process.process, deploy, mode)
+            except Exception:
+                deploy.status = ProcessStatus.error
+                error("Unexpected error in `{deploy.name}`.\n{traceback}"
+                      .format(deploy=deploy, traceback=traceback.format_exc()))
+
+    async def _wait_for_stable(self, service):
+        awsutils = self.process.awsutils
+        tracker = ServiceStabilityTracker(
+            service_name=service.service_name,
+            failed_tasks_threshold=self.process.service_failed_tasks_threshold,
+            placement_failure_timeout=self.process.service_placement_failure_timeout
+        )
+        for interval in self.process.poll_intervals(service):
+            if interval > 0:
+                await asyncio.sleep(interval)
+            try:
+                res_service = await self.loop.run_in_executor(
+                    None, awsutils.describe_service, service.task_environment.cluster_name, service.service_name
+                )
+            except EcsServiceNotFoundException:
+                service_wait_failed(service, "service not found.")
+                return
+            state = tracker.observe(res_service)
+            if self.process.is_stream_service_events:
+                service_wait_progress(service, tracker)
+            if state == StableState.success:
+                service_stable(
+                    service=service,
+                    res_service=res_service,
+                    deregister_queue=self.process.deregister_queue
+                )
+                return
+            if state == StableState.failure:
+                service_wait_failed(service, tracker.diagnostic)
+                return
+        service_wait_timeout(service)
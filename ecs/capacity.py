@@ -0,0 +1,105 @@
+# coding: utf-8
+from threading import Lock
+
+import ecs.service
+
+
+def get_task_size(task_definition: dict) -> tuple:
+    """
+    CPU units and memory (MiB) reserved by one task
+    :param task_definition: the task definition
+    :return: (cpu, memory)
+    """
+    cpu = 0
+    memory = 0
+    for container_definition in task_definition.get('containerDefinitions', []):
+        cpu += int(container_definition.get('cpu', 0))
+        memory += int(container_definition.get('memoryReservation', container_definition.get('memory', 0)))
+    # タスクレベルの指定があればそちらが予約される
+    if task_definition.get('cpu') is not None:
+        cpu = int(task_definition['cpu'])
+    if task_definition.get('memory') is not None:
+        memory = int(task_definition['memory'])
+    return cpu, memory
+
+
+def is_fargate(task_definition: dict) -> bool:
+    # Fargateのタスクはコンテナインスタンスの空きを使わない
+    compatibilities = task_definition.get('requiresCompatibilities') or []
+    return 'FARGATE' in compatibilities and 'EC2' not in compatibilities
+
+
+def get_rollout_task_count(service: ecs.service.Service) -> int:
+    """
+    Number of tasks the rollout runs on top of the running ones:
+    the surge allowed by maximumPercent, plus the scale out if desiredCount grows.
+    """
+    desired_count = service.task_environment.desired_count
+    origin_desired_count = service.origin_desired_count
+    if origin_desired_count is None:
+        return desired_count
+    scale_out = max(desired_count - origin_desired_count, 0)
+    if service.is_detached_metadata and service.is_same_task_definition():
+        # タスクを入れ替えない
+        return scale_out
+    surge = max(desired_count * service.task_environment.maximum_percent // 100 - desired_count, 0)
+    return surge + scale_out
+
+
+class ClusterCapacity(object):
+    """
+    Free CPU and memory of a cluster, reserved by the rollouts in flight
+    """
+    def __init__(self, cluster_name: str, remaining_cpu: int, remaining_memory: int,
+                 registered_cpu: int, registered_memory: int):
+        self.cluster_name = cluster_name
+        self.remaining_cpu = remaining_cpu
+        self.remaining_memory = remaining_memory
+        self.registered_cpu = registered_cpu
+        self.registered_memory = registered_memory
+
+    def fits(self, cpu: int, memory: int) -> bool:
+        return cpu <= self.remaining_cpu and memory <= self.remaining_memory
+
+    def reserve(self, cpu: int, memory: int):
+        self.remaining_cpu -= cpu
+        self.remaining_memory -= memory
+
+    def release(self, cpu: int, memory: int):
+        self.remaining_cpu += cpu
+        self.remaining_memory += memory
+
+
+class RolloutScheduler(object):
+    """
+    Admits service rollouts per cluster only while the cluster has room for their surge tasks
+    """
+    def __init__(self, capacity_list: list):
+        self.capacities = {x.cluster_name: x for x in capacity_list}
+        self.reservations = {}
+        self.lock = Lock()
+
+    def get_demand(self, service: ecs.service.Service) -> tuple:
+        count = get_rollout_task_count(service)
+        cpu, memory = get_task_size(service.task_definition)
+        return cpu * count, memory * count
+
+    def admit(self, service: ecs.service.Service, is_force: bool=False) -> bool:
+        with self.lock:
+            capacity = self.capacities.get(service.task_environment.cluster_name)
+            if capacity is None or is_fargate(service.task_definition):
+                return True
+            cpu, memory = self.get_demand(service)
+            if not is_force and not capacity.fits(cpu, memory):
+                return False
+            capacity.reserve(cpu, memory)
+            self.reservations[service.service_name] = (capacity, cpu, memory)
+            return True
+
+    def release(self, service: ecs.service.Service):
+        with self.lock:
+            reservation = self.reservations.pop(service.service_name, None)
+            if reservation is None:
+                return
+            capacity, cpu, memory = reservation
+            capacity.release(cpu, memory)
@@ -12,6 +12,10 @@ class ProcessMode(enum.Enum):
     stopScheduledTask = 14
     stopBeforeDeploy = 15
     deleteService = 16
+    registerTaskDefinition = 17
+    deregisterTaskDefinition = 18
+    collectTaskDefinitionGarbage = 19
+    rolloutService = 20
 
 
 class ProcessStatus(enum.Enum):
@@ -24,15 +28,44 @@ class DeployTargetType(enum.Enum):
     service_describe = 1
     scheduled_task = 2
     cloudwatch_event = 3
+    task_definition = 4
 
 
 class Deploy(object):
+    __slots__ = ('name', 'status', 'target_type')
+
     def __init__(self, name, target_type):
         self.name = name
         self.status = ProcessStatus.normal
         self.target_type = target_type
 
 
+class DeployScope(object):
+    """
+    The environment and template group handled by this deploy.
+    Discovered services and rules out of the scope keep only their identity.
+    """
+    __slots__ = ('environment', 'template_group')
+
+    def __init__(self, environment, template_group):
+        self.environment = environment
+        self.template_group = template_group
+
+    def contains(self, task_environment) -> bool:
+        if self.environment != task_environment.environment:
+            return False
+        if self.template_group is not None and self.template_group != task_environment.template_group:
+            return False
+        return True
+
+    def contains_tags(self, tags: dict) -> bool:
+        if self.environment != tags.get('ENVIRONMENT'):
+            return False
+        if self.template_group is not None and self.template_group != tags.get('TEMPLATE_GROUP'):
+            return False
+        return True
+
+
 class ParameterNotFoundException(Exception):
     pass
 
@@ -0,0 +1,143 @@
+# coding: utf-8
+import copy
+from collections import OrderedDict
+
+import jinja2
+import jinja2.meta
+
+# services.ymlでrenderされるエントリ
+deploy_names = ('services', 'scheduledTasks')
+
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield from _strings(k)
+            yield from _strings(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from _strings(v)
+
+
+class DependencyIndex(object):
+    """
+    Variables and templates each service and scheduled task is rendered from,
+    found from the jinja2 AST of the services.yml and the environment yaml without rendering them.
+    """
+    def __init__(self, services_config: dict, environment_config: dict):
+        self.services_config = services_config
+        self.environment_config = environment_config
+        self.jinja_env = jinja2.Environment()
+        self.undeclared_variables = {}
+        # 変数 -> エントリ, テンプレート -> エントリ
+        self.variables = {}
+        self.templates = {}
+        self.entries = {}
+
+        # 環境設定の値が参照している変数
+        definitions = {}
+        for key, value in environment_config.items():
+            if key in deploy_names:
+                continue
+            definitions[key] = self._find_variables(value)
+
+        templates = services_config.get('taskDefinitionTemplates') or {}
+        for deploy_name in deploy_names:
+            environment_entries = environment_config.get(deploy_name) or {}
+            for name, base_config in (services_config.get(deploy_name) or {}).items():
+                base_config = base_config or {}
+                environment_entry = environment_entries.get(name) or {}
+                variables = self._find_variables(base_config) | self._find_variables(environment_entry)
+                template_name = environment_entry.get('taskDefinitionTemplate', base_config.get('taskDefinitionTemplate'))
+                if template_name is not None:
+                    self.templates.setdefault(template_name, set()).add((deploy_name, name))
+                    variables |= self._find_variables(templates.get(template_name))
+                # 環境設定の値を経由して参照している変数
+                stack = list(variables)
+                while len(stack) > 0:
+                    for variable in definitions.get(stack.pop(), ()):
+                        if variable not in variables:
+                            variables.add(variable)
+                            stack.append(variable)
+                variables.discard('item')
+                self.entries[(deploy_name, name)] = variables
+                for variable in variables:
+                    self.variables.setdefault(variable, set()).add((deploy_name, name))
+
+    def _find_variables(self, value) -> set:
+        variables = set()
+        for text in _strings(value):
+            if '{' not in text:
+                continue
+            found = self.undeclared_variables.get(text)
+            if found is None:
+                try:
+                    found = jinja2.meta.find_undeclared_variables(self.jinja_env.parse(text))
+                except jinja2.exceptions.TemplateSyntaxError:
+                    # renderする時にエラーになる
+                    found = set()
+                self.undeclared_variables[text] = found
+            variables |= found
+        return variables
+
+    def dependents(self, variable: str) -> set:
+        return self.variables.get(variable, set())
+
+    def affected(self, base_services_config: dict, base_environment_config: dict) -> set:
+        """
+        Entries whose rendering may differ from the base configs
+        :param base_services_config: services.yml before the change
+        :param base_environment_config: environment yaml before the change
+        :return: set of (deploy_name, name) in services_config
+        """
+        all_entries = set(self.entries.keys())
+        for key in set(self.services_config.keys()) | set(base_services_config.keys()):
+            if key in deploy_names or key == 'taskDefinitionTemplates':
+                continue
+            if self.services_config.get(key) != base_services_config.get(key):
+                return all_entries
+
+        affected = set()
+        for deploy_name in deploy_names:
+            entries = self.services_config.get(deploy_name) or {}
+            base_entries = base_services_config.get(deploy_name) or {}
+            environment_entries = self.environment_config.get(deploy_name) or {}
+            base_environment_entries = base_environment_config.get(deploy_name) or {}
+            for name in entries:
+                if name not in base_entries or entries[name] != base_entries[name] \
+                        or environment_entries.get(name) != base_environment_entries.get(name):
+                    affected.add((deploy_name, name))
+
+        templates = self.services_config.get('taskDefinitionTemplates') or {}
+        base_templates = base_services_config.get('taskDefinitionTemplates') or {}
+        for template_name in set(templates.keys()) | set(base_templates.keys()):
+            if templates.get(template_name) != base_templates.get(template_name):
+                affected |= self.templates.get(template_name, set())
+
+        for key in set(self.environment_config.keys()) | set(base_environment_config.keys()):
+            if key in deploy_names:
+                continue
+            if self.environment_config.get(key) != base_environment_config.get(key):
+                # コンテナのENVIRONMENTになる
+                if key == 'environment':
+                    return all_entries
+                affected |= self.dependents(key)
+        return affected
+
+
+def select_entries(services_config: dict, entries: set) -> dict:
+    """
+    Copy of services_config with only the given services and scheduled tasks
+    :param services_config: services.yml
+    :param entries: set of (deploy_name, name)
+    :return: services config
+    """
+    selected = copy.copy(services_config)
+    for deploy_name in deploy_names:
+        if not services_config.get(deploy_name):
+            continue
+        selected[deploy_name] = OrderedDict(
+            (name, config) for name, config in services_config[deploy_name].items() if (deploy_name, name) in entries)
+    return selected
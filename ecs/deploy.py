@@ -1,43 +1,74 @@
 # coding: utf-8
+import itertools
 import json
-import os
 import time
 import traceback
 import sys
 from queue import Queue, Empty
-from threading import Thread
-from botocore.exceptions import WaiterError
+from threading import Thread, Event
 import yaml
 import yamlordereddictloader
 
 import render
-from aws import AwsUtils, EcsServiceNotFoundException, CloudwatchEventRuleNotFoundException
-from ecs.classes import ProcessMode, ProcessStatus, VariableNotFoundException
+from aws import AwsUtils, Throttle, LambdaPolicyCache, poll_intervals, EcsServiceNotFoundException, \
+    CloudwatchEventRuleNotFoundException
+from ecs.classes import ProcessMode, ProcessStatus, DeployScope, VariableNotFoundException
 from ecs.scheduled_tasks import ScheduledTask, get_scheduled_task_list, get_deploy_scheduled_task_list, \
     CloudwatchEventRule, CloudWatchEventState, scheduled_task_managed_description
 import ecs.service
-from ecs.utils import h1, h2, success, error, info
+from ecs.capacity import ClusterCapacity, RolloutScheduler
+from ecs.dependency import DependencyIndex, select_entries
+from ecs.history import DeployHistory
+from ecs.journal import DeployJournal
+from ecs.plan import plan_version, save_plan, load_plan, get_stale_services, service_to_plan, service_from_plan, \
+    scheduled_task_to_plan, scheduled_task_from_plan, describe_service_to_plan, cloudwatch_event_rule_to_plan, \
+    cloudwatch_event_rule_from_plan
+from ecs.render_cache import RenderCache
+from ecs.schedule import get_minute_histogram
+from ecs.shard import parse_shard, select_shard_entries
+from ecs.stability import ServiceStabilityTracker, StableState
+from ecs.task_definition import TaskDefinitionRegistration, TaskDefinitionFamily, \
+    get_task_definition_registration_list, get_task_definition_family_list
+from ecs.utils import h1, h2, success, error, info, get_resource_tags, task_definition_fingerprint
 
 
 class DeployProcess(Thread):
     def __init__(self, task_queue, key, secret, region, is_service_zero_keep, is_stop_before_deploy,
-                 is_service_update_only, is_task_definition_update_only, service_wait_max_attempts, service_wait_delay):
+                 is_service_update_only, is_task_definition_update_only, service_wait_max_attempts, service_wait_delay,
+                 is_adaptive_service_wait, service_failed_tasks_threshold, service_placement_failure_timeout,
+                 is_stream_service_events, is_show_diff, is_resource_tags, throttle,
+                 lambda_policy_cache, deregister_queue, rollout_queue, history, journal, stop_event,
+                 role_arn=None, discovery=None):
         super().__init__()
         self.task_queue = task_queue
-        self.awsutils = AwsUtils(access_key=key, secret_key=secret, region=region)
+        self.stop_event = stop_event
+        self.discovery = discovery
+        self.deregister_queue = deregister_queue
+        self.rollout_queue = rollout_queue
+        self.history = history
+        self.journal = journal
+        self.awsutils = AwsUtils(access_key=key, secret_key=secret, region=region, throttle=throttle,
+                                 lambda_policy_cache=lambda_policy_cache, role_arn=role_arn)
         self.is_service_zero_keep = is_service_zero_keep
         self.is_stop_before_deploy = is_stop_before_deploy
         self.is_service_update_only = is_service_update_only
         self.is_task_definition_update_only = is_task_definition_update_only
         self.service_wait_max_attempts = service_wait_max_attempts
         self.service_wait_delay = service_wait_delay
+        self.is_adaptive_service_wait = is_adaptive_service_wait
+        self.service_failed_tasks_threshold = service_failed_tasks_threshold
+        self.service_placement_failure_timeout = service_placement_failure_timeout
+        self.is_stream_service_events = is_stream_service_events
+        self.is_show_diff = is_show_diff
+        self.is_resource_tags = is_resource_tags
 
     def run(self):
-        while True:
+        # DeployManagerが終わるまで動く
+        while not self.stop_event.is_set():
             try:
                 deploy, mode = self.task_queue.get_nowait()
             except Empty:
-                time.sleep(1)
+                self.stop_event.wait(1)
                 continue
             # noinspection PyBroadException
             try:
@@ -52,6 +83,8 @@ class DeployProcess(Thread):
     def process(self, deploy, mode):
         if deploy.status == ProcessStatus.error:
             error("`{deploy.name}` previous process error. skipping.".format(deploy=deploy))
+            if mode == ProcessMode.rolloutService:
+                self.rollout_queue.put(deploy)
             return
 
         if mode == ProcessMode.fetchServices:
@@ -64,12 +97,15 @@ class DeployProcess(Thread):
             self.check_deploy_service(deploy)
 
         elif mode == ProcessMode.waitForStable:
-            wait_for_stable(
-                awsutils=self.awsutils,
-                service=deploy,
-                max_attempts=self.service_wait_max_attempts,
-                delay=self.service_wait_delay
-            )
+            self.wait_for_stable(deploy)
+
+        elif mode == ProcessMode.rolloutService:
+            try:
+                self.process_service(deploy)
+                self.wait_for_stable(deploy)
+            finally:
+                # 容量の予約を返す
+                self.rollout_queue.put(deploy)
 
         elif mode == ProcessMode.deployScheduledTask:
             self.deploy_scheduled_task(deploy)
@@ -89,7 +125,12 @@ class DeployProcess(Thread):
         elif mode == ProcessMode.deleteService:
             self.delete_service(deploy)
 
+        elif mode == ProcessMode.registerTaskDefinition:
+            self.register_task_definition(deploy)
+
     def stop_before_deploy(self, service: ecs.service.Service):
+        # 止まるまで(wait_for_stable)の時間を記録する
+        self.history.start(service.service_name, 'stop')
         self.__update_service(
             service=service,
             desired_count=0,
@@ -100,6 +141,43 @@ class DeployProcess(Thread):
                 "    - 0 task desired"
                 .format(service=service))
 
+    def wait_for_stable(self, service: ecs.service.Service):
+        started = time.time()
+        wait_for_stable(
+            awsutils=self.awsutils,
+            service=service,
+            intervals=self.poll_intervals(service),
+            failed_tasks_threshold=self.service_failed_tasks_threshold,
+            placement_failure_timeout=self.service_placement_failure_timeout,
+            is_stream_service_events=self.is_stream_service_events,
+            deregister_queue=self.deregister_queue
+        )
+        self.record_wait(service, started)
+
+    def poll_intervals(self, service: ecs.service.Service):
+        # 最初はすぐに確認する
+        if not self.is_adaptive_service_wait:
+            return [0] + [self.service_wait_delay] * (self.service_wait_max_attempts - 1)
+        phase = 'stop' if self.history.is_started(service.service_name, 'stop') else 'stable'
+        expected = self.history.expected(service.service_name, (phase,))
+        return itertools.chain([0], poll_intervals(
+            timeout=self.service_wait_delay * self.service_wait_max_attempts,
+            maximum=self.service_wait_delay * 3,
+            expected=expected if expected > 0 else None
+        ))
+
+    def record_wait(self, service: ecs.service.Service, started: float):
+        if service.status == ProcessStatus.error:
+            return
+        if self.history.is_started(service.service_name, 'stop'):
+            self.history.finish(service.service_name, 'stop')
+            # 再開した時に止める前のタスク数に戻す
+            self.journal.record(service.service_name, 'stop', desired_count=service.origin_desired_count)
+        else:
+            self.history.record(service.service_name, 'stable', time.time() - started)
+            self.journal.record(service.service_name, 'stable', arn=service.task_definition_arn,
+                                fingerprint=task_definition_fingerprint(service.task_definition))
+
     def stop_scheduled_task(self, scheduled_task: ScheduledTask):
         if not scheduled_task.task_exists:
             return
@@ -122,15 +200,48 @@ class DeployProcess(Thread):
             )
 
     def fetch_cloudwatch_event(self, cloud_watch_event_rule: CloudwatchEventRule):
-        task_definition = self.__describe_task_definition(name=cloud_watch_event_rule.name)
+        task_definition = self.__discover_task_definition(name=cloud_watch_event_rule.name)
         cloud_watch_event_rule.set_from_task_definition(task_definition)
 
+    def register_task_definition(self, registration: TaskDefinitionRegistration):
+        started = time.time()
+        try:
+            task_definition = self.awsutils.register_task_definition(
+                task_definition=registration.task_definition,
+                tags=self.__resource_tags(registration.deploy_list[0])
+            )
+        except Exception:
+            for deploy in registration.deploy_list:
+                deploy.status = ProcessStatus.error
+            raise
+        registration.set_task_definition_arn(task_definition)
+        for deploy in registration.deploy_list:
+            self.history.record(deploy.name, 'register', time.time() - started)
+            self.journal.record(deploy.name, 'register', arn=registration.task_definition_arn,
+                                fingerprint=registration.fingerprint)
+        success("Register task definition '{registration.family}' succeeded.\n\033[39m"
+                "    - arn: '{registration.task_definition_arn}'\n"
+                "    - {count:d} target(s)"
+                .format(registration=registration, count=len(registration.deploy_list)))
+
     def deploy_scheduled_task(self, scheduled_task: ScheduledTask):
-        if not scheduled_task.is_same_task_definition():
-            res_reg = self.awsutils.register_task_definition(task_definition=scheduled_task.task_definition)
+        if scheduled_task.task_definition_arn is None and not scheduled_task.is_same_task_definition():
+            res_reg = self.awsutils.register_task_definition(
+                task_definition=scheduled_task.task_definition,
+                tags=self.__resource_tags(scheduled_task)
+            )
             scheduled_task.task_definition_arn = res_reg['taskDefinitionArn']
+            self.journal.record(scheduled_task.name, 'register', arn=scheduled_task.task_definition_arn,
+                                fingerprint=task_definition_fingerprint(scheduled_task.task_definition))
         self.awsutils.create_scheduled_task(
             scheduled_task=scheduled_task, description=scheduled_task_managed_description)
+        # lambdaからECSターゲットに切り替えたら、lambdaの実行権限はもういらない
+        if scheduled_task.is_ecs_target() and scheduled_task.origin_task_environment is not None \
+                and scheduled_task.origin_task_environment.target_lambda_arn is not None:
+            self.awsutils.remove_permission(
+                name=scheduled_task.family,
+                target_arn=scheduled_task.origin_task_environment.target_lambda_arn
+            )
 
         message = """Deploy Scheduled Task '{scheduled_task.name}' succeeded.\033[39m
    - Cloudwatch Event State: {scheduled_task.state.value}"""\
@@ -155,7 +266,22 @@ class DeployProcess(Thread):
         if not self.is_service_update_only:
             self.__register_task_definition(service)
         if not self.is_task_definition_update_only:
-            self.__update_service(service=service, desired_count=service.task_environment.desired_count)
+            # 前回の実行で更新済みならロールアウトをやり直さない
+            if self.journal.is_done(service.service_name, 'update', service.origin_task_definition_arn,
+                                    task_definition_fingerprint(service.task_definition)):
+                success("Service '{service.service_name}' was updated by the previous run. skipped."
+                        .format(service=service))
+                return
+            started = time.time()
+            self.__update_service(
+                service=service,
+                desired_count=service.task_environment.desired_count,
+                force_new_deployment=not (service.is_detached_metadata and service.is_same_task_definition())
+            )
+            self.history.record(service.service_name, 'update', time.time() - started)
+            self.journal.record(service.service_name, 'update', arn=service.task_definition_arn,
+                                origin_arn=service.origin_task_definition_arn,
+                                fingerprint=task_definition_fingerprint(service.task_definition))
             message = """Deploy Service '{service.service_name}' succeeded.\033[39m""".format(service=service)
         if not self.is_service_update_only:
             if message is None:
@@ -173,7 +299,7 @@ class DeployProcess(Thread):
         success(message)
 
     def fetch_service(self, describe_service: ecs.service.DescribeService):
-        task_definition = self.__describe_task_definition(name=describe_service.task_definition_arn)
+        task_definition = self.__discover_task_definition(name=describe_service.task_definition_arn)
         describe_service.set_from_task_definition(task_definition)
 
     def check_deploy_service(self, service: ecs.service.Service):
@@ -193,7 +319,7 @@ class DeployProcess(Thread):
             error("Service '{service.service_name}' status not Active. will be recreated.".format(service=service))
             return
 
-        checks = service.compare_container_definition()
+        checks = service.compare_container_definition(is_show_diff=self.is_show_diff)
 
         success("Checking service '{service.service_name}' succeeded "
                 "({service.running_count:d} / {service.desired_count:d})\n\033[39m{checks}"
@@ -212,7 +338,7 @@ class DeployProcess(Thread):
                       .format(scheduled_task=scheduled_task))
                 return
 
-        checks = scheduled_task.compare_container_definition()
+        checks = scheduled_task.compare_container_definition(is_show_diff=self.is_show_diff)
 
         success("Checking scheduled task '{scheduled_task.name}' succeeded. \n\033[39m{checks}"
                 .format(scheduled_task=scheduled_task, checks=checks))
@@ -238,6 +364,7 @@ class DeployProcess(Thread):
             load_balancers=service.load_balancers,
             network_configuration=service.network_configuration,
             service_registries=service.service_registries,
+            tags=self.__resource_tags(service)
         )
         service.update_run_count(describe_service=res_service, is_stop_before_deploy=False, is_create_service=True)
         return res_service
@@ -250,6 +377,15 @@ class DeployProcess(Thread):
         task_definition = service.task_definition_arn
         if task_definition is None:
             task_definition = service.task_definition.get('family')
+        placement_strategy = None
+        placement_constraints = None
+        # タスク定義に配置の設定がないので、サービスの設定で上書きする
+        if service.is_detached_metadata:
+            placement_strategy = service.placement_strategy or []
+            placement_constraints = []
+            if service.task_environment.distinct_instance:
+                placement_constraints.append({'type': 'distinctInstance'})
+            placement_constraints.extend(service.placement_constraints or [])
         try:
             res_service = self.awsutils.update_service(
                 cluster=service.task_environment.cluster_name,
@@ -259,6 +395,8 @@ class DeployProcess(Thread):
                 minimum_healthy_percent=service.task_environment.minimum_healthy_percent,
                 desired_count=desired_count,
                 force_new_deployment=force_new_deployment,
+                placement_strategy=placement_strategy,
+                placement_constraints=placement_constraints,
             )
         except EcsServiceNotFoundException:
             error("Service '{service.service_name}' not Found. will be created.".format(service=service))
@@ -266,33 +404,155 @@ class DeployProcess(Thread):
             res_service = self.__create_service(service)
         service.update_run_count(describe_service=res_service, is_stop_before_deploy=is_stop_before_deploy)
 
+    def __resource_tags(self, deploy):
+        if not self.is_resource_tags:
+            return None
+        return get_resource_tags(deploy.task_environment)
+
     def __describe_task_definition(self, name: str) -> dict:
         task_definition = self.awsutils.describe_task_definition(name=name)
         return task_definition
 
+    def __discover_task_definition(self, name: str) -> dict:
+        # 複数の環境では他の環境のサービスとルールも分類するので、一度だけ取得する
+        if self.discovery is not None:
+            return self.discovery.describe_task_definition(self.awsutils, name)
+        return self.__describe_task_definition(name)
+
     def __register_task_definition(self, service: ecs.service.Service):
+        # already registered in the registration step
+        if service.task_definition_arn is not None:
+            return
         # if same task definition, then do not register.
         if service.is_same_task_definition():
             return
-        task_definition = self.awsutils.register_task_definition(task_definition=service.task_definition)
+        task_definition = self.awsutils.register_task_definition(
+            task_definition=service.task_definition,
+            tags=self.__resource_tags(service)
+        )
         service.set_task_definition_arn(task_definition)
+        self.journal.record(service.service_name, 'register', arn=service.task_definition_arn,
+                            fingerprint=task_definition_fingerprint(service.task_definition))
+
+
+class DeregisterProcess(Thread):
+    """
+    Low priority worker for deregistering task definitions.
+    Takes a job only while the deploy queue is idle, so it never delays the deploy itself.
+    """
+    def __init__(self, task_queue, deregister_queue, key, secret, region, throttle, journal, stop_event,
+                 role_arn=None):
+        super().__init__()
+        self.task_queue = task_queue
+        self.stop_event = stop_event
+        self.deregister_queue = deregister_queue
+        self.journal = journal
+        self.awsutils = AwsUtils(access_key=key, secret_key=secret, region=region, throttle=throttle,
+                                 role_arn=role_arn)
+        # stopBeforeDeploy services wait for stable twice, so the same arn can be queued twice
+        self.deregistered_arn_set = set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.task_queue.unfinished_tasks > 0:
+                self.stop_event.wait(1)
+                continue
+            try:
+                target, mode = self.deregister_queue.get_nowait()
+            except Empty:
+                self.stop_event.wait(1)
+                continue
+            # noinspection PyBroadException
+            try:
+                self.process(target, mode)
+            except Exception:
+                error("Unexpected error in deregistering `{target}`.\n{traceback}"
+                      .format(target=target, traceback=traceback.format_exc()))
+            finally:
+                self.deregister_queue.task_done()
+
+    def process(self, target, mode):
+        if mode == ProcessMode.deregisterTaskDefinition:
+            self.deregister_task_definition(target)
+
+        elif mode == ProcessMode.collectTaskDefinitionGarbage:
+            self.collect_task_definition_garbage(target)
+
+    def deregister_task_definition(self, task_definition_arn: str):
+        if task_definition_arn in self.deregistered_arn_set:
+            return
+        if self.journal.get(task_definition_arn, 'deregister') is not None:
+            return
+        self.awsutils.deregister_task_definition(task_definition_arn)
+        self.deregistered_arn_set.add(task_definition_arn)
+        self.journal.record(task_definition_arn, 'deregister')
+        success("Deregister task definition '{task_definition_arn}'".format(task_definition_arn=task_definition_arn))
+
+    def collect_task_definition_garbage(self, family: TaskDefinitionFamily):
+        garbage = family.get_garbage(self.awsutils.list_task_definitions(family.family))
+        if len(garbage) == 0:
+            return
+        for task_definition_arn in garbage:
+            self.awsutils.deregister_task_definition(task_definition_arn)
+            self.deregistered_arn_set.add(task_definition_arn)
+            self.journal.record(task_definition_arn, 'deregister')
+        success("Deregister {count:d} old revision(s) of task definition '{family.family}'.\n\033[39m"
+                "    - keep latest {family.keep_revisions:d} revision(s)"
+                .format(count=len(garbage), family=family))
 
 
 class DeployManager(object):
-    def __init__(self, args):
+    def __init__(self, args, region: str=None, role_arn: str=None, rendered: tuple=None, file_suffix: str='',
+                 discovery=None, throttle: Throttle=None):
+        """
+        :param region: region to deploy to instead of --region
+        :param role_arn: role to assume with --key and --secret, to deploy to another account
+        :param rendered: result of get_deploy_list, when it is shared by several deploys
+        :param file_suffix: suffix of the history and journal files, when they are shared by several deploys
+        :param discovery: SharedDiscovery, when the deploys of several environments read ECS once
+        :param throttle: api budget, when several deploys use the same account and region
+        """
         self._args = args
 
-        self.awsutils = AwsUtils(access_key=args.key, secret_key=args.secret, region=args.region)
+        self.key = args.key
+        self.secret = args.secret
+        self.role_arn = role_arn
+        self.region = args.region if region is None else region
+        self.rendered = rendered
+        self.file_suffix = file_suffix
+        self.discovery = discovery
+        # アカウントとリージョンごとに一つの予算でAPIを呼ぶ
+        if throttle is None:
+            throttle = Throttle(concurrency=args.api_concurrency)
+        self.throttle = throttle
+
+        self.awsutils = AwsUtils(access_key=self.key, secret_key=self.secret, region=self.region,
+                                 throttle=self.throttle, role_arn=self.role_arn)
         self.task_queue = Queue()
+        self.deregister_queue = Queue()
+        self.rollout_queue = Queue()
 
-        self.cluster_list = self.awsutils.list_clusters()
+        self.cluster_list = None
+        self.shard = None
+        if getattr(args, 'shard', None) is not None:
+            self.shard = parse_shard(args.shard)
         self.threads_count = args.threads_count
+        # deleteにはないオプション
+        self.engine = getattr(args, 'engine', 'thread')
+        self.async_concurrency = getattr(args, 'async_concurrency', 200)
+        self.stop_event = Event()
+        self.threads = []
+        self.is_threads_started = False
+        self.lambda_policy_cache = LambdaPolicyCache()
+        self.history = DeployHistory()
+        self.journal = DeployJournal()
         self.service_wait_max_attempts = args.service_wait_max_attempts
         self.service_wait_delay = args.service_wait_delay
-
-        self.key = args.key
-        self.secret = args.secret
-        self.region = args.region
+        self.is_adaptive_service_wait = getattr(args, 'adaptive_service_wait', True)
+        self.service_failed_tasks_threshold = getattr(args, 'service_failed_tasks_threshold', 0)
+        self.service_placement_failure_timeout = getattr(args, 'service_placement_failure_timeout', 0)
+        self.is_stream_service_events = getattr(args, 'stream_service_events', True)
+        self.is_show_diff = False
 
         self.error = False
 
@@ -314,6 +574,8 @@ class DeployManager(object):
 
         self.delete_scheduled_task_list = []
         self.scheduled_task_list = []
+        # 削除対象はECSの取得かplanから決まる
+        self.is_fetched = False
 
         self.environment = None
         self.template_group = None
@@ -322,36 +584,71 @@ class DeployManager(object):
         self.is_delete_unused_service = True
         self.is_service_update_only = False
         self.is_task_definition_update_only = False
+        self.task_definition_keep_revisions = 0
+        self.is_resource_tags = False
+        self.is_capacity_aware_rollout = False
+        self.capacity_wait_timeout = 900
         self.force = False
 
     def _service_config(self):
-        self.all_service_list,\
-            self.all_deploy_target_service_list,\
-            self.scheduled_task_list,\
-            self.deploy_scheduled_task_list,\
-            self.environment = get_deploy_list(
+        if self.rendered is None:
+            self.rendered = get_deploy_list(
                 services_yaml=self._args.services_yaml,
                 environment_yaml=self._args.environment_yaml,
                 task_definition_template_dir=self._args.task_definition_template_dir,
                 task_definition_config_json=self._args.task_definition_config_json,
                 task_definition_config_env=self._args.task_definition_config_env,
                 deploy_service_group=self._args.deploy_service_group,
-                template_group=self._args.template_group
+                template_group=self._args.template_group,
+                is_detach_service_metadata=self._args.detach_service_metadata,
+                render_cache_dir=self._args.render_cache_dir,
+                base_services_yaml=self._args.base_services_yaml,
+                base_environment_yaml=self._args.base_environment_yaml,
+                shard=self.shard
             )
+        self.all_service_list,\
+            self.all_deploy_target_service_list,\
+            self.scheduled_task_list,\
+            self.deploy_scheduled_task_list,\
+            self.environment = self.rendered
+        self._set_options()
+
+    def _set_options(self):
         # thread数がタスクの数を超えているなら減らす
         deploy_size = len(self.deploy_scheduled_task_list) + len(self.all_deploy_target_service_list)
         if deploy_size < self.threads_count:
-            self.threads_count = deploy_size
+            # 取得と削除のためにthreadは一つは必要
+            self.threads_count = max(deploy_size, 1)
         self.is_service_zero_keep = self._args.service_zero_keep
-        self.template_group = self._args.template_group
-        self.is_delete_unused_service = self._args.delete_unused_service
-        self.is_stop_before_deploy = self._args.stop_before_deploy
-        self.is_service_update_only = self._args.service_update_only
-        self.is_task_definition_update_only = self._args.task_definition_update_only
+        # renderのオプションはapplyにはなく、planの値を使う
+        self.template_group = getattr(self._args, 'template_group', None)
+        # 他のシャードのサービスは見えないので、削除はまとめて行う
+        self.is_delete_unused_service = getattr(self._args, 'delete_unused_service', True) and self.shard is None
+        self.is_stop_before_deploy = getattr(self._args, 'stop_before_deploy', True)
+        self.is_service_update_only = getattr(self._args, 'service_update_only', False)
+        self.is_task_definition_update_only = getattr(self._args, 'task_definition_update_only', False)
+        self.is_show_diff = self._args.show_diff
+        self.task_definition_keep_revisions = self._args.task_definition_keep_revisions
+        self.is_resource_tags = self._args.resource_tags
+        self.is_capacity_aware_rollout = self._args.capacity_aware_rollout
+        self.capacity_wait_timeout = self._args.capacity_wait_timeout
+        self.history = DeployHistory(path=self._get_file_path(self._args.deploy_history))
+
+    def _is_nothing_to_do(self) -> bool:
+        # シャードや変更の影響でデプロイするものがなくても、未使用のサービスは削除する
+        return len(self.all_deploy_target_service_list) == 0 and len(self.deploy_scheduled_task_list) == 0 \
+            and not self.is_delete_unused_service
+
+    def _get_file_path(self, path: str) -> str:
+        if path is None:
+            return None
+        return path + self.file_suffix
 
     def _set_deploy_list(self):
         for service in self.all_deploy_target_service_list:
-            if self.is_stop_before_deploy and service.stop_before_deploy:
+            # タスクを入れ替えないサービスは止める必要がない
+            is_unchanged = service.is_detached_metadata and service.is_same_task_definition()
+            if self.is_stop_before_deploy and service.stop_before_deploy and not is_unchanged:
                 if service.is_primary_placement:
                     self.primary_stop_before_deploy_service_list.append(service)
                 else:
@@ -362,13 +659,146 @@ class DeployManager(object):
                 else:
                     self.remain_deploy_service_list.append(service)
 
+        # 時間のかかるサービスから始める
+        for service_list in (self.primary_stop_before_deploy_service_list, self.stop_before_deploy_service_list,
+                             self.primary_deploy_service_list, self.remain_deploy_service_list):
+            service_list.sort(key=lambda x: self.history.expected(x.service_name), reverse=True)
+
+    def _critical_path(self):
+        if not self.history.has_records():
+            return
+        levels = []
+        if not self.is_service_update_only:
+            levels.append(("register task definition", self.all_deploy_target_service_list, ('register',)))
+        if not self.is_task_definition_update_only:
+            levels.append(("stop service before deploy",
+                           self.primary_stop_before_deploy_service_list + self.stop_before_deploy_service_list,
+                           ('stop',)))
+            levels.append(("deploy primary service", self.primary_deploy_service_list, ('update', 'stable')))
+            levels.append(("deploy service", self.remain_deploy_service_list, ('update', 'stable')))
+            levels.append(("start primary service after deploy", self.primary_stop_before_deploy_service_list,
+                           ('update', 'stable')))
+            levels.append(("start service after deploy", self.stop_before_deploy_service_list, ('update', 'stable')))
+        h1("Step: Predicted Critical Path")
+        total = 0
+        for label, service_list, phases in levels:
+            if len(service_list) == 0:
+                continue
+            service = max(service_list, key=lambda x: self.history.expected(x.service_name, phases))
+            seconds = self.history.expected(service.service_name, phases)
+            total += seconds
+            info("{label}: '{service.service_name}' {seconds:.0f}s".format(label=label, service=service,
+                                                                          seconds=seconds))
+        success("Predicted deploy time: {total:.0f}s".format(total=total))
+
     def _unstopped_primary_stop_before_deploy_service_list(self) -> list:
-        return [x for x in self.primary_stop_before_deploy_service_list]
+        return [x for x in self.primary_stop_before_deploy_service_list
+                if self.journal.get(x.service_name, 'stop') is None and not self._is_stable(x)]
 
     def _unstopped_stop_before_deploy_service_list(self) -> list:
-        return [x for x in self.stop_before_deploy_service_list]
+        return [x for x in self.stop_before_deploy_service_list
+                if self.journal.get(x.service_name, 'stop') is None and not self._is_stable(x)]
+
+    def _is_stable(self, service: ecs.service.Service) -> bool:
+        # 前回の実行で今のタスク定義に入れ替わって安定していて、設定も変わっていない
+        return self.journal.is_done(service.service_name, 'stable', service.origin_task_definition_arn,
+                                    task_definition_fingerprint(service.task_definition))
+
+    def _unfinished_service_list(self, service_list: list) -> list:
+        return [x for x in service_list if not self._is_stable(x)]
+
+    def _resume(self):
+        if not self.journal.has_steps():
+            return
+        h1("Step: Resume Deploy")
+        for deploy in self.all_deploy_target_service_list + self.deploy_scheduled_task_list:
+            registered = self.journal.get(deploy.name, 'register')
+            if registered is not None and deploy.task_definition_arn is None \
+                    and registered['fingerprint'] == task_definition_fingerprint(deploy.task_definition):
+                deploy.task_definition_arn = registered['arn']
+        for service in self.all_deploy_target_service_list:
+            stopped = self.journal.get(service.service_name, 'stop')
+            if stopped is not None:
+                service.origin_desired_count = stopped['desired_count']
+            updated = self.journal.get(service.service_name, 'update')
+            if self.journal.is_done(service.service_name, 'update', service.origin_task_definition_arn,
+                                    task_definition_fingerprint(service.task_definition)):
+                # 更新前のリビジョンは前回の実行では登録解除されていない
+                if updated['origin_arn'] is not None and updated['origin_arn'] != updated['arn']:
+                    self.deregister_queue.put([updated['origin_arn'], ProcessMode.deregisterTaskDefinition])
+            if self._is_stable(service):
+                success("Service '{service.service_name}' was deployed by the previous run. skipped."
+                        .format(service=service))
+        success("Resumed {count:d} step(s) of the previous run.".format(count=len(self.journal.steps)))
 
     def _start_threads(self):
+        self.is_threads_started = True
+        if self.engine == 'asyncio':
+            self._start_event_loop()
+        else:
+            self._start_deploy_threads()
+        thread = DeregisterProcess(
+            task_queue=self.task_queue,
+            deregister_queue=self.deregister_queue,
+            key=self.key,
+            secret=self.secret,
+            region=self.region,
+            throttle=self.throttle,
+            journal=self.journal,
+            stop_event=self.stop_event,
+            role_arn=self.role_arn
+        )
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _stop_threads(self):
+        # agentのように同じprocessでデプロイを繰り返すので、workerを残さない
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.engine == 'asyncio' and self.is_threads_started:
+            self.task_queue.close()
+            self.is_threads_started = False
+
+    def _start_event_loop(self):
+        # asyncio engineは必要なときだけ読み込む
+        from ecs.async_deploy import AsyncTaskQueue
+        process = DeployProcess(
+            task_queue=None,
+            key=self.key,
+            secret=self.secret,
+            region=self.region,
+            is_service_zero_keep=self.is_service_zero_keep,
+            is_stop_before_deploy=self.is_stop_before_deploy,
+            is_service_update_only=self.is_service_update_only,
+            is_task_definition_update_only=self.is_task_definition_update_only,
+            service_wait_max_attempts=self.service_wait_max_attempts,
+            service_wait_delay=self.service_wait_delay,
+            is_adaptive_service_wait=self.is_adaptive_service_wait,
+            service_failed_tasks_threshold=self.service_failed_tasks_threshold,
+            service_placement_failure_timeout=self.service_placement_failure_timeout,
+            is_stream_service_events=self.is_stream_service_events,
+            is_show_diff=self.is_show_diff,
+            is_resource_tags=self.is_resource_tags,
+            throttle=self.throttle,
+            lambda_policy_cache=self.lambda_policy_cache,
+            deregister_queue=self.deregister_queue,
+            rollout_queue=self.rollout_queue,
+            history=self.history,
+            journal=self.journal,
+            stop_event=self.stop_event,
+            role_arn=self.role_arn,
+            discovery=self.discovery
+        )
+        self.task_queue = AsyncTaskQueue(
+            process=process,
+            executor_size=self.threads_count,
+            concurrency=self.async_concurrency
+        )
+
+    def _start_deploy_threads(self):
         # threadの開始
         for _ in range(self.threads_count):
             thread = DeployProcess(
@@ -381,13 +811,39 @@ class DeployManager(object):
                 is_service_update_only=self.is_service_update_only,
                 is_task_definition_update_only=self.is_task_definition_update_only,
                 service_wait_max_attempts=self.service_wait_max_attempts,
-                service_wait_delay=self.service_wait_delay
+                service_wait_delay=self.service_wait_delay,
+                is_adaptive_service_wait=self.is_adaptive_service_wait,
+                service_failed_tasks_threshold=self.service_failed_tasks_threshold,
+                service_placement_failure_timeout=self.service_placement_failure_timeout,
+                is_stream_service_events=self.is_stream_service_events,
+                is_show_diff=self.is_show_diff,
+                is_resource_tags=self.is_resource_tags,
+                throttle=self.throttle,
+                lambda_policy_cache=self.lambda_policy_cache,
+                deregister_queue=self.deregister_queue,
+                rollout_queue=self.rollout_queue,
+                history=self.history,
+                journal=self.journal,
+                stop_event=self.stop_event,
+                role_arn=self.role_arn,
+                discovery=self.discovery
             )
             thread.setDaemon(True)
             thread.start()
+            self.threads.append(thread)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            self._stop_threads()
+
+    def _run(self):
         self._service_config()
+        if self._is_nothing_to_do():
+            return
+        self.journal = DeployJournal(path=self._get_file_path(self._args.journal_file), environment=self.environment,
+                                     is_resume=self._args.resume)
         self._start_threads()
         if not self.is_service_update_only:
             self._fetch_ecs_information()
@@ -399,7 +855,14 @@ class DeployManager(object):
         if not self.is_service_update_only:
             self._check_deploy()
 
+        self._resume()
         self._set_deploy_list()
+        self._critical_path()
+        self._deploy()
+
+    def _deploy(self):
+        if not self.is_service_update_only:
+            self._register_task_definition()
 
         if not (self.is_service_update_only or self.is_task_definition_update_only):
             self._stop_scheduled_task()
@@ -412,11 +875,138 @@ class DeployManager(object):
         if not (self.is_service_update_only or self.is_task_definition_update_only):
             self._deploy_scheduled_task()
 
+        self._deregister_task_definition()
+        self.history.save()
+
         if not self.is_task_definition_update_only:
             self._result_check()
+        self.journal.finish()
+
+    def plan(self):
+        try:
+            self._plan()
+        finally:
+            self._stop_threads()
+
+    def _plan(self):
+        self._service_config()
+        self.is_show_diff = True
+        self._start_threads()
+        if not self.is_service_update_only:
+            self._fetch_ecs_information()
+        if not (self.is_service_update_only or self.is_task_definition_update_only):
+            self._delete_unused(dry_run=True)
+        if not self.is_service_update_only:
+            self._check_deploy()
+        self._set_deploy_list()
+        self._critical_path()
+
+        h1("Step: Save Deploy Plan")
+        plan = self._get_plan()
+        save_plan(self._args.plan_file, plan)
+        for action in plan['actions']:
+            info("{step}: {count:d}".format(step=action['step'], count=len(action['targets'])))
+        success("Plan saved to '{path}'".format(path=self._args.plan_file))
+
+    def _get_plan(self) -> dict:
+        delete_service_list = []
+        delete_scheduled_task_list = []
+        if self.is_delete_unused_service and not (self.is_service_update_only or self.is_task_definition_update_only):
+            delete_service_list = self.delete_service_list
+            delete_scheduled_task_list = self.delete_scheduled_task_list
+        # 実行する順番
+        actions = [
+            ('deleteService', [x.service_name for x in delete_service_list]),
+            ('deleteScheduledTask', [x.name for x in delete_scheduled_task_list]),
+            ('stopPrimaryServiceBeforeDeploy', [x.service_name for x in self.primary_stop_before_deploy_service_list]),
+            ('stopServiceBeforeDeploy', [x.service_name for x in self.stop_before_deploy_service_list]),
+            ('deployPrimaryService', [x.service_name for x in self.primary_deploy_service_list]),
+            ('deployService', [x.service_name for x in self.remain_deploy_service_list]),
+            ('deployScheduledTask', [x.name for x in self._changed_scheduled_task_list()]),
+        ]
+        return {
+            'version': plan_version,
+            'environment': self.environment,
+            'template_group': self.template_group,
+            'options': {
+                'delete_unused_service': self.is_delete_unused_service,
+                'stop_before_deploy': self.is_stop_before_deploy,
+                'service_update_only': self.is_service_update_only,
+                'task_definition_update_only': self.is_task_definition_update_only,
+            },
+            'services': [service_to_plan(x) for x in self.all_deploy_target_service_list],
+            'scheduled_tasks': [scheduled_task_to_plan(x) for x in self.deploy_scheduled_task_list],
+            'delete_services': [describe_service_to_plan(x) for x in delete_service_list],
+            'delete_scheduled_tasks': [cloudwatch_event_rule_to_plan(x) for x in delete_scheduled_task_list],
+            'actions': [{'step': step, 'targets': targets} for step, targets in actions],
+        }
+
+    def apply(self):
+        try:
+            self._apply()
+        finally:
+            self._stop_threads()
+
+    def _apply(self):
+        h1("Step: Load Deploy Plan")
+        plan = load_plan(self._args.plan_file)
+        self._set_plan(plan)
+        self._start_threads()
+
+        # planの後にサービスが変わっていれば適用しない
+        h1("Step: Check Deploy Plan")
+        stale_messages = get_stale_services(self.awsutils, plan)
+        if len(stale_messages) > 0:
+            for message in stale_messages:
+                error(message)
+            error("Plan is stale. create the plan again.")
+            sys.exit(1)
+        success("Plan for environment `{environment}` is up to date.".format(environment=self.environment))
+
+        if not (self.is_service_update_only or self.is_task_definition_update_only):
+            self._delete_unused()
+        self._critical_path()
+        self._deploy()
+
+    def _set_plan(self, plan: dict):
+        self.all_deploy_target_service_list = [service_from_plan(x) for x in plan['services']]
+        self.all_service_list = self.all_deploy_target_service_list
+        self.deploy_scheduled_task_list = [scheduled_task_from_plan(x) for x in plan['scheduled_tasks']]
+        self.scheduled_task_list = self.deploy_scheduled_task_list
+        self.delete_service_list = [ecs.service.DescribeService(service_description=x)
+                                    for x in plan['delete_services']]
+        self.delete_scheduled_task_list = [cloudwatch_event_rule_from_plan(x) for x in plan['delete_scheduled_tasks']]
+        # planを作った時に取得している
+        self.is_fetched = True
+        self._set_options()
+        self.environment = plan['environment']
+        self.template_group = plan['template_group']
+        self.is_delete_unused_service = plan['options']['delete_unused_service']
+        self.is_stop_before_deploy = plan['options']['stop_before_deploy']
+        self.is_service_update_only = plan['options']['service_update_only']
+        self.is_task_definition_update_only = plan['options']['task_definition_update_only']
+
+        services = {x.service_name: x for x in self.all_deploy_target_service_list}
+        actions = {x['step']: x['targets'] for x in plan['actions']}
+        self.primary_stop_before_deploy_service_list = [services[x] for x in actions['stopPrimaryServiceBeforeDeploy']]
+        self.stop_before_deploy_service_list = [services[x] for x in actions['stopServiceBeforeDeploy']]
+        self.primary_deploy_service_list = [services[x] for x in actions['deployPrimaryService']]
+        self.remain_deploy_service_list = [services[x] for x in actions['deployService']]
+        success("Plan for environment `{environment}`: {services:d} service(s), {tasks:d} scheduled task(s)"
+                .format(environment=self.environment, services=len(self.all_deploy_target_service_list),
+                        tasks=len(self.deploy_scheduled_task_list)))
 
     def dry_run(self):
+        try:
+            self._dry_run()
+        finally:
+            self._stop_threads()
+
+    def _dry_run(self):
         self._service_config()
+        if self._is_nothing_to_do():
+            return
+        self.is_show_diff = True
         self._start_threads()
         self._fetch_ecs_information()
 
@@ -425,8 +1015,52 @@ class DeployManager(object):
         # Step: Check Service
         self._check_deploy()
         self._set_deploy_list()
+        self._critical_path()
+        self._scheduled_task_histogram()
+
+    def delete_unused(self):
+        try:
+            self._run_delete_unused()
+        finally:
+            self._stop_threads()
+
+    def _run_delete_unused(self):
+        """
+        Coordinator of sharded deploys: render every shard and delete only the unused services and scheduled tasks
+        """
+        self._service_config()
+        # 削除するためのコマンドなので、--delete-unused-serviceによらず削除する
+        self.is_delete_unused_service = True
+        self._start_threads()
+        self._fetch_ecs_information()
+        self._delete_unused(dry_run=False)
+        error_service_list = [x for x in self.delete_service_list if x.status == ProcessStatus.error]
+        if len(error_service_list) > 0:
+            error("Failed to delete {count:d} unused service(s).".format(count=len(error_service_list)))
+            sys.exit(1)
+        success("Deleted {services:d} unused service(s) and {tasks:d} unused scheduled task(s)."
+                .format(services=len(self.delete_service_list), tasks=len(self.delete_scheduled_task_list)))
+
+    def _scheduled_task_histogram(self):
+        if len(self.deploy_scheduled_task_list) == 0:
+            return
+        h1("Step: Scheduled Task Starts per Minute")
+        histogram = get_minute_histogram(self.deploy_scheduled_task_list)
+        if len(histogram) == 0:
+            info("No schedule with a known start minute.")
+            return
+        for minute in sorted(histogram):
+            print("  :{minute:02d} {bar} {count:d}".format(minute=minute, bar='#' * histogram[minute],
+                                                          count=histogram[minute]))
+        info("")
 
     def delete(self):
+        try:
+            self._delete()
+        finally:
+            self._stop_threads()
+
+    def _delete(self):
         self.environment = self._args.environment
         self.force = self._args.force
         self._start_threads()
@@ -447,49 +1081,82 @@ class DeployManager(object):
                 return
         self._delete_unused()
 
+    def _register_task_definition(self):
+        deploy_list = list(self.all_deploy_target_service_list)
+        if not self.is_task_definition_update_only:
+            deploy_list.extend(self.deploy_scheduled_task_list)
+        registration_list = get_task_definition_registration_list(deploy_list)
+        if len(registration_list) > 0:
+            h1("Step: Register Task Definition")
+            for registration in registration_list:
+                self.task_queue.put([registration, ProcessMode.registerTaskDefinition])
+            self.task_queue.join()
+
+    def _changed_scheduled_task_list(self) -> list:
+        return [x for x in self.deploy_scheduled_task_list if not x.is_unchanged()]
+
     def _stop_scheduled_task(self):
-        if len(self.deploy_scheduled_task_list) > 0:
+        # 変更のないスケジュールタスクは実行中のタスクを止めない
+        changed_scheduled_task_list = self._changed_scheduled_task_list()
+        if len(changed_scheduled_task_list) > 0:
             h1("Step: Stop ECS Scheduled Task")
-            for task in self.deploy_scheduled_task_list:
+            for task in changed_scheduled_task_list:
                 self.task_queue.put([task, ProcessMode.stopScheduledTask])
             self.task_queue.join()
 
     def _stop_before_deploy(self):
-        if len(self._unstopped_primary_stop_before_deploy_service_list()) > 0 \
-                or len(self._unstopped_stop_before_deploy_service_list()) > 0:
+        primary_stop_before_deploy_service_list = self._unstopped_primary_stop_before_deploy_service_list()
+        stop_before_deploy_service_list = self._unstopped_stop_before_deploy_service_list()
+        if len(primary_stop_before_deploy_service_list) > 0 or len(stop_before_deploy_service_list) > 0:
             h1("Step: Stop ECS Service Before Deploy")
-            for service in self._unstopped_primary_stop_before_deploy_service_list():
+            for service in primary_stop_before_deploy_service_list:
                 self.task_queue.put([service, ProcessMode.stopBeforeDeploy])
-            for service in self._unstopped_stop_before_deploy_service_list():
+            for service in stop_before_deploy_service_list:
                 self.task_queue.put([service, ProcessMode.stopBeforeDeploy])
             self.task_queue.join()
             h2("Wait for Service Status 'Stable'")
-            self._wait_for_stable(self._unstopped_primary_stop_before_deploy_service_list())
-            self._wait_for_stable(self._unstopped_stop_before_deploy_service_list())
+            self._wait_for_stable(primary_stop_before_deploy_service_list)
+            self._wait_for_stable(stop_before_deploy_service_list)
 
     def _start_after_deploy(self):
-        if len(self.primary_stop_before_deploy_service_list) > 0:
+        primary_stop_before_deploy_service_list = self._unfinished_service_list(
+            self.primary_stop_before_deploy_service_list)
+        if len(primary_stop_before_deploy_service_list) > 0:
             h1("Step: Start Primary ECS Service After Deploy")
-            for service in self.primary_stop_before_deploy_service_list:
+            for service in primary_stop_before_deploy_service_list:
                 self.task_queue.put([service, ProcessMode.deployService])
             self.task_queue.join()
             h2("Wait for Service Status 'Stable'")
-            self._wait_for_stable(self.primary_stop_before_deploy_service_list)
-        if len(self.stop_before_deploy_service_list) > 0:
+            self._wait_for_stable(primary_stop_before_deploy_service_list)
+        stop_before_deploy_service_list = self._unfinished_service_list(self.stop_before_deploy_service_list)
+        if len(stop_before_deploy_service_list) > 0:
             h1("Step: Start ECS Service After Deploy")
-            for service in self.stop_before_deploy_service_list:
+            for service in stop_before_deploy_service_list:
                 self.task_queue.put([service, ProcessMode.deployService])
             self.task_queue.join()
             h2("Wait for Service Status 'Stable'")
-            self._wait_for_stable(self.stop_before_deploy_service_list)
+            self._wait_for_stable(stop_before_deploy_service_list)
 
     def _deploy_scheduled_task(self):
         if len(self.deploy_scheduled_task_list) > 0:
             h1("Step: Deploy ECS Scheduled Task")
             for task in self.deploy_scheduled_task_list:
+                if task.is_unchanged():
+                    success("Scheduled Task '{task.name}' is not changed. skipped.".format(task=task))
+                    continue
                 self.task_queue.put([task, ProcessMode.deployScheduledTask])
             self.task_queue.join()
 
+    def _deregister_task_definition(self):
+        if self.task_definition_keep_revisions > 0:
+            deploy_list = [x for x in self.all_deploy_target_service_list if x.status == ProcessStatus.normal]
+            deploy_list.extend([x for x in self.deploy_scheduled_task_list if x.status == ProcessStatus.normal])
+            for family in get_task_definition_family_list(deploy_list, self.task_definition_keep_revisions):
+                self.deregister_queue.put([family, ProcessMode.collectTaskDefinitionGarbage])
+        if self.deregister_queue.unfinished_tasks > 0:
+            h1("Step: Deregister Task Definition")
+            self.deregister_queue.join()
+
     def _delete_unused(self, dry_run=False):
         if dry_run:
             h1("Step: Check Delete Unused")
@@ -498,6 +1165,9 @@ class DeployManager(object):
         if not self.is_delete_unused_service:
             info("Do not delete unused")
             return
+        if not self.is_fetched:
+            # 取得していなければ削除対象が空になり、何も削除せずに成功してしまう
+            raise Exception("Unused services and scheduled tasks are not fetched from ECS.")
         if len(self.delete_service_list) == 0 and len(self.delete_scheduled_task_list) == 0:
             info("There was no service or task to delete.")
         for service in self.delete_service_list:
@@ -515,19 +1185,40 @@ class DeployManager(object):
 
     def _fetch_ecs_information(self, is_all=False):
         h1("Step: Fetch ECS Information")
+        scope = DeployScope(environment=self.environment, template_group=self.template_group)
         describe_service_list = []
+        if self.cluster_list is None:
+            if self.shard is not None:
+                # シャードのサービスがあるクラスタだけ取得する
+                self.cluster_list = self.awsutils.find_clusters(
+                    sorted(set([x.task_environment.cluster_name for x in self.all_service_list])))
+            elif self.discovery is not None:
+                self.cluster_list = self.discovery.list_clusters()
+            else:
+                self.cluster_list = self.awsutils.list_clusters()
         if len(self.all_service_list) > 0 or is_all:
             describe_service_list = ecs.service.fetch_aws_service(
-                cluster_list=self.cluster_list, awsutils=self.awsutils
+                cluster_list=self.cluster_list, awsutils=self.awsutils, scope=scope,
+                discovery=self.discovery
             )
+            service_names = set([x.service_name for x in self.all_service_list])
             for s in describe_service_list:
+                # タグ付きのサービスはタグで分類し、スコープ外ならタスク定義を取得しない
+                if s.is_tagged() and not scope.contains_tags(s.tags):
+                    continue
+                # シャードでは削除しないので、他のシャードのサービスは取得しない
+                if self.shard is not None and s.service_name not in service_names:
+                    continue
                 self.task_queue.put([s, ProcessMode.fetchServices])
         cloud_watch_rule_list = []
         if len(self.scheduled_task_list) > 0 or is_all:
-            rules = self.awsutils.list_cloudwatch_event_rules()
+            if self.discovery is not None:
+                rules = self.discovery.list_cloudwatch_event_rules()
+            else:
+                rules = self.awsutils.list_cloudwatch_event_rules()
             for r in rules:
                 if r.get('Description') == scheduled_task_managed_description:
-                    c = CloudwatchEventRule(r)
+                    c = CloudwatchEventRule(r, scope=scope)
                     cloud_watch_rule_list.append(c)
                     self.task_queue.put([c, ProcessMode.fetchCloudwatchEvents])
         while self.task_queue.qsize() > 0:
@@ -538,11 +1229,10 @@ class DeployManager(object):
 
         # set service description and get delete servicelist
         for describe_service in describe_service_list:
-            if self.environment != describe_service.task_environment.environment:
+            if describe_service.task_environment is None:
+                continue
+            if not scope.contains(describe_service.task_environment):
                 continue
-            if self.template_group is not None:
-                if self.template_group != describe_service.task_environment.template_group:
-                    continue
             is_delete = True
             for service in self.all_service_list:
                 if service.service_name == describe_service.service_name:
@@ -553,11 +1243,8 @@ class DeployManager(object):
             if is_delete:
                 self.delete_service_list.append(describe_service)
         for cloud_watch_rule in cloud_watch_rule_list:
-            if self.environment != cloud_watch_rule.task_environment.environment:
+            if not scope.contains(cloud_watch_rule.task_environment):
                 continue
-            if self.template_group is not None:
-                if self.template_group != cloud_watch_rule.task_environment.template_group:
-                    continue
             is_delete = True
             for scheduled_task in self.scheduled_task_list:
                 if scheduled_task.family == cloud_watch_rule.family:
@@ -566,23 +1253,108 @@ class DeployManager(object):
                     break
             if is_delete:
                 self.delete_scheduled_task_list.append(cloud_watch_rule)
+        self.is_fetched = True
         success("Check succeeded")
 
     def _deploy_service(self):
-        if len(self.primary_deploy_service_list) > 0:
+        primary_deploy_service_list = self._unfinished_service_list(self.primary_deploy_service_list)
+        if len(primary_deploy_service_list) > 0:
             h1("Step: Deploy Primary ECS Service")
-            for service in self.primary_deploy_service_list:
-                self.task_queue.put([service, ProcessMode.deployService])
-            self.task_queue.join()
-            h2("Wait for Service Status 'Stable'")
-            self._wait_for_stable(self.primary_deploy_service_list)
-        if len(self.remain_deploy_service_list) > 0:
+            self._deploy_service_list(primary_deploy_service_list)
+        remain_deploy_service_list = self._unfinished_service_list(self.remain_deploy_service_list)
+        if len(remain_deploy_service_list) > 0:
             h1("Step: Deploy ECS Service")
-            for service in self.remain_deploy_service_list:
-                self.task_queue.put([service, ProcessMode.deployService])
+            self._deploy_service_list(remain_deploy_service_list)
+
+    def _deploy_service_list(self, service_list: list):
+        if self.is_capacity_aware_rollout:
+            self._rollout_service_list(service_list)
+            return
+        for service in service_list:
+            self.task_queue.put([service, ProcessMode.deployService])
+        self.task_queue.join()
+        h2("Wait for Service Status 'Stable'")
+        self._wait_for_stable(service_list)
+
+    def _rollout_service_list(self, service_list: list):
+        # クラスタの空きに入る分だけデプロイし、安定したら次を入れる
+        scheduler = self._get_rollout_scheduler(service_list)
+        pending_service_list = list(service_list)
+        # サービス名ごとの流しているサービスと期限
+        in_flight = {}
+        is_expired = False
+        admitted = time.time()
+        while len(pending_service_list) > 0 or len(in_flight) > 0:
+            for service in list(pending_service_list):
+                if service.status == ProcessStatus.error:
+                    pending_service_list.remove(service)
+                    continue
+                # 何も流れていなければ、空きが足りなくても1つは流す
+                if scheduler.admit(service, is_force=len(in_flight) == 0):
+                    pending_service_list.remove(service)
+                    admitted = time.time()
+                    in_flight[service.service_name] = (service, admitted + self._rollout_timeout())
+                    self.task_queue.put([service, ProcessMode.rolloutService])
+            if len(in_flight) == 0:
+                break
+            deadlines = [deadline for _, deadline in in_flight.values()]
+            if len(pending_service_list) > 0:
+                info("{count:d} service(s) waiting for cluster capacity.".format(count=len(pending_service_list)))
+                deadlines.append(admitted + self.capacity_wait_timeout)
+            try:
+                service = self.rollout_queue.get(timeout=max(min(deadlines) - time.time(), 0))
+            except Empty:
+                now = time.time()
+                if len(pending_service_list) > 0 and now >= admitted + self.capacity_wait_timeout:
+                    error("No cluster capacity for {count:d} service(s) in {seconds:d} seconds."
+                          .format(count=len(pending_service_list), seconds=self.capacity_wait_timeout))
+                    for service in pending_service_list:
+                        service.status = ProcessStatus.error
+                    pending_service_list = []
+                    self.error = True
+                for service_name, (service, deadline) in list(in_flight.items()):
+                    if now < deadline:
+                        continue
+                    # 安定待ちのtimeoutを過ぎても返ってこないものは待たない
+                    error("Rollout of '{service_name}' did not finish in {seconds:d} seconds."
+                          .format(service_name=service_name, seconds=self._rollout_timeout()))
+                    service.status = ProcessStatus.error
+                    del in_flight[service_name]
+                    is_expired = True
+                    self.error = True
+                continue
+            # 期限切れで諦めたものが遅れて返ってきた
+            if service.service_name not in in_flight:
+                continue
+            scheduler.release(service)
+            del in_flight[service.service_name]
+        if not is_expired:
             self.task_queue.join()
-            h2("Wait for Service Status 'Stable'")
-            self._wait_for_stable(self.remain_deploy_service_list)
+
+    def _rollout_timeout(self) -> int:
+        # 1つのロールアウトは更新と安定待ちで終わるので、それを過ぎたら返ってこないとみなす
+        return self.service_wait_delay * self.service_wait_max_attempts + 300
+
+    def _get_rollout_scheduler(self, service_list: list) -> RolloutScheduler:
+        capacity_list = []
+        for cluster_name in sorted(set([x.task_environment.cluster_name for x in service_list])):
+            resources = self.awsutils.get_container_instance_resources(cluster_name)
+            if resources['registered']['CPU'] == 0 and resources['registered']['MEMORY'] == 0:
+                # Fargateだけのクラスタはコンテナインスタンスの空きで制限しない
+                info("cluster '{cluster_name}': no container instance, rollouts are not limited."
+                     .format(cluster_name=cluster_name))
+                continue
+            capacity = ClusterCapacity(
+                cluster_name=cluster_name,
+                remaining_cpu=resources['remaining']['CPU'],
+                remaining_memory=resources['remaining']['MEMORY'],
+                registered_cpu=resources['registered']['CPU'],
+                registered_memory=resources['registered']['MEMORY']
+            )
+            info("cluster '{c.cluster_name}': free cpu {c.remaining_cpu:d} / {c.registered_cpu:d},"
+                 " free memory {c.remaining_memory:d} / {c.registered_memory:d}".format(c=capacity))
+            capacity_list.append(capacity)
+        return RolloutScheduler(capacity_list)
 
     def _check_deploy(self):
         h1("Step: Check Deploy ECS Service and Scheduled tasks")
@@ -612,67 +1384,64 @@ class DeployManager(object):
             sys.exit(1)
 
 
-def deregister_task_definition(awsutils, service: ecs.service.Service):
+def deregister_task_definition(deregister_queue, service: ecs.service.Service):
     if service.origin_task_definition_arn is None:
         return
     if service.is_same_task_definition():
         return
-    awsutils.deregister_task_definition(service.origin_task_definition_arn)
+    deregister_queue.put([service.origin_task_definition_arn, ProcessMode.deregisterTaskDefinition])
 
 
-def wait_for_stable(awsutils, service: ecs.service.Service, delay: int, max_attempts: int):
-    try:
-        res_service = awsutils.wait_for_stable(
-            cluster_name=service.task_environment.cluster_name,
-            service_name=service.service_name,
-            max_attempts=max_attempts,
-            delay=delay
-        )
-        service.update_run_count(describe_service=res_service, is_stop_before_deploy=False)
-        deregister_task_definition(awsutils, service)
-        success(
-            "service '{service.service_name}' ({service.running_count:d} / {service.desired_count}) update completed."
-            .format(service=service))
-    except WaiterError:
-        service.status = ProcessStatus.error
-        error("service '{service.service_name}' update wait timeout.".format(service=service))
+def wait_for_stable(awsutils, service: ecs.service.Service, intervals,
+                    failed_tasks_threshold: int, placement_failure_timeout: int, is_stream_service_events: bool,
+                    deregister_queue):
+    tracker = ServiceStabilityTracker(service_name=service.service_name, failed_tasks_threshold=failed_tasks_threshold,
+                                      placement_failure_timeout=placement_failure_timeout)
+    for interval in intervals:
+        if interval > 0:
+            time.sleep(interval)
+        try:
+            res_service = awsutils.describe_service(
+                cluster=service.task_environment.cluster_name,
+                service=service.service_name
+            )
+        except EcsServiceNotFoundException:
+            service_wait_failed(service, "service not found.")
+            return
+        state = tracker.observe(res_service)
+        if is_stream_service_events:
+            service_wait_progress(service, tracker)
+        if state == StableState.success:
+            service_stable(service=service, res_service=res_service, deregister_queue=deregister_queue)
+            return
+        if state == StableState.failure:
+            service_wait_failed(service, tracker.diagnostic)
+            return
+    service_wait_timeout(service)
 
 
-def test_templates(args):
-    h1("Step: Check ECS Template")
-    environment = None
-    files = os.listdir(args.environment_yaml_dir)
-    if files is None or len(files) == 0:
-        raise Exception("environment yaml file not found.")
-    services_config = yaml.load(args.services_yaml, Loader=yamlordereddictloader.Loader)
-    for f in files:
-        file_path = os.path.join(args.environment_yaml_dir, f)
-        if os.path.isfile(file_path):
-            with open(file_path, 'r') as environment_yaml:
-                environment_config = yaml.load(environment_yaml.read(), Loader=yamlordereddictloader.Loader)
-
-                environment = environment_config.get("environment")
-                if environment is None:
-                    raise VariableNotFoundException("%s requires parameter `environment`." % file_path)
-                environment = render.render_template(
-                    str(environment),
-                    environment_config,
-                    args.task_definition_config_env
-                )
+def service_wait_progress(service: ecs.service.Service, tracker: ServiceStabilityTracker):
+    for progress in tracker.progress:
+        info("[{service.service_name}] {progress}".format(service=service, progress=progress))
 
-                ecs.service.get_service_list_yaml(
-                    services_config=services_config,
-                    environment_config=environment_config,
-                    is_task_definition_config_env=args.task_definition_config_env,
-                    environment=environment
-                )
-                get_scheduled_task_list(
-                    services_config=services_config,
-                    environment_config=environment_config,
-                    is_task_definition_config_env=args.task_definition_config_env,
-                    environment=environment
-                )
-        success("Template check environment `{environment}` done.".format(environment=environment))
+
+def service_stable(service: ecs.service.Service, res_service: dict, deregister_queue):
+    service.update_run_count(describe_service=res_service, is_stop_before_deploy=False)
+    deregister_task_definition(deregister_queue, service)
+    success(
+        "service '{service.service_name}' ({service.running_count:d} / {service.desired_count}) update completed."
+        .format(service=service))
+
+
+def service_wait_timeout(service: ecs.service.Service):
+    service.status = ProcessStatus.error
+    error("service '{service.service_name}' update wait timeout.".format(service=service))
+
+
+def service_wait_failed(service: ecs.service.Service, diagnostic: str):
+    service.status = ProcessStatus.error
+    error("service '{service.service_name}' update failed.\n    - {diagnostic}"
+          .format(service=service, diagnostic=diagnostic))
 
 
 def get_deploy_list(
@@ -682,13 +1451,28 @@ def get_deploy_list(
         task_definition_config_json,
         task_definition_config_env,
         deploy_service_group,
-        template_group
+        template_group,
+        is_detach_service_metadata=False,
+        render_cache_dir=None,
+        base_services_yaml=None,
+        base_environment_yaml=None,
+        shard=None,
+        services_config=None,
+        base_services_config=None
 ):
+    """
+    :param services_config: parsed services yaml, when it is shared by the deploys of several environments
+    :param base_services_config: parsed base services yaml, when it is shared by the deploys of several environments
+    """
     h1("Step: Check ECS Template")
     scheduled_task_list = []
     deploy_scheduled_task_list = []
-    if services_yaml:
-        services_config = yaml.load(services_yaml, Loader=yamlordereddictloader.Loader)
+    affected = None
+    if services_yaml or services_config is not None:
+        if services_config is None:
+            services_config = yaml.load(services_yaml, Loader=yamlordereddictloader.Loader)
+        if base_services_config is None and base_services_yaml is not None:
+            base_services_config = yaml.load(base_services_yaml, Loader=yamlordereddictloader.Loader)
         environment_config = yaml.load(environment_yaml, Loader=yamlordereddictloader.Loader)
 
         environment = environment_config.get("environment")
@@ -696,22 +1480,62 @@ def get_deploy_list(
             raise VariableNotFoundException("environment-yaml requires parameter `environment`.")
         environment = render.render_template(str(environment), environment_config, task_definition_config_env)
 
+        # シャードのサービスとスケジュールタスクだけrenderする
+        if shard is not None:
+            shard_entries = select_shard_entries(services_config, environment_config, task_definition_config_env, shard)
+            if len(shard_entries) == 0:
+                success("No service or scheduled task in shard {index:d}/{count:d}.".format(
+                    index=shard[0], count=shard[1]))
+                return [], [], [], [], environment
+            info("shard {index:d}/{count:d}: {selected:d} service(s) and scheduled task(s)".format(
+                index=shard[0], count=shard[1], selected=len(shard_entries)))
+            services_config = select_entries(services_config, shard_entries)
+
+        render_cache = None
+        if render_cache_dir is not None:
+            render_cache = RenderCache(
+                cache_dir=render_cache_dir,
+                services_config=services_config,
+                environment_config=environment_config,
+                environment=environment,
+                is_task_definition_config_env=task_definition_config_env,
+                options={'detach_service_metadata': is_detach_service_metadata}
+            )
+
         service_list = ecs.service.get_service_list_yaml(
             services_config=services_config,
             environment_config=environment_config,
             is_task_definition_config_env=task_definition_config_env,
-            environment=environment
+            environment=environment,
+            is_detach_service_metadata=is_detach_service_metadata,
+            render_cache=render_cache
         )
 
         scheduled_task_list = get_scheduled_task_list(
             services_config=services_config,
             environment_config=environment_config,
             is_task_definition_config_env=task_definition_config_env,
-            environment=environment
+            environment=environment,
+            render_cache=render_cache
         )
+        if render_cache is not None:
+            info("Render cache: {hits} hit(s), {misses} rendered.".format(
+                hits=render_cache.hits, misses=render_cache.misses))
         deploy_scheduled_task_list = get_deploy_scheduled_task_list(
             scheduled_task_list, deploy_service_group, template_group)
 
+        # 変更前の設定から影響を受けるものだけデプロイする
+        if base_services_config is not None or base_environment_yaml is not None:
+            if base_services_config is None:
+                base_services_config = services_config
+            base_environment_config = environment_config
+            if base_environment_yaml is not None:
+                base_environment_config = yaml.load(base_environment_yaml, Loader=yamlordereddictloader.Loader)
+            affected = DependencyIndex(services_config, environment_config).affected(
+                base_services_config, base_environment_config)
+            deploy_scheduled_task_list = [x for x in deploy_scheduled_task_list
+                                          if ('scheduledTasks', x.config_name) in affected]
+
     else:
         task_definition_config = json.load(task_definition_config_json)
         environment = task_definition_config['environment']
@@ -721,6 +1545,14 @@ def get_deploy_list(
             task_definition_config_env=task_definition_config_env
         )
     deploy_service_list = ecs.service.get_deploy_service_list(service_list, deploy_service_group, template_group)
+    if affected is not None:
+        deploy_service_list = [x for x in deploy_service_list if ('services', x.config_name) in affected]
+        if len(deploy_service_list) == 0 and len(deploy_scheduled_task_list) == 0:
+            # 削除は全サービスを見て行うので、全サービスは返す
+            success("No service or scheduled task is affected by the change.")
+            return service_list, [], scheduled_task_list, [], environment
+        info("{count} service(s) and scheduled task(s) are affected by the change.".format(
+            count=len(deploy_service_list) + len(deploy_scheduled_task_list)))
 
     # duplicate name check
     for deploy_service in deploy_service_list:
@@ -0,0 +1,99 @@
+# coding: utf-8
+import json
+
+from ecs.utils import adjust_container_definition
+
+
+class ContainerDefinitionDiff(object):
+    """
+    Diff of two container definition lists.
+    Containers are matched by `name`, and lists of named items (environment, secrets, ...) by item `name`,
+    so a reordering is not reported as a change.
+    The diff is built only when converted to str, and stops after `max_lines` lines.
+    """
+    def __init__(self, origin: list, target: list, max_lines: int=200, max_value_length: int=120):
+        self.origin = origin
+        self.target = target
+        self.max_lines = max_lines
+        self.max_value_length = max_value_length
+
+    def __str__(self):
+        lines = []
+        for line in self._diff_containers():
+            if len(lines) >= self.max_lines:
+                lines.append("      ... (diff is truncated at {max_lines:d} lines)".format(max_lines=self.max_lines))
+                break
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _diff_containers(self):
+        origin = adjust_container_definition(self.origin)
+        target = adjust_container_definition(self.target)
+        origin_dict = _to_named_dict(origin)
+        target_dict = _to_named_dict(target)
+        if origin_dict is None or target_dict is None:
+            origin_dict = dict(enumerate(origin))
+            target_dict = dict(enumerate(target))
+        for name in origin_dict:
+            if name not in target_dict:
+                yield "    - container '{name}'".format(name=name)
+        for name, container in target_dict.items():
+            if name not in origin_dict:
+                yield "    + container '{name}'".format(name=name)
+                continue
+            changes = list(self._diff_value('', origin_dict[name], container))
+            if len(changes) > 0:
+                yield "    container '{name}':".format(name=name)
+                for change in changes:
+                    yield change
+
+    def _diff_value(self, path: str, a, b):
+        if a == b:
+            return
+        if isinstance(a, dict) and isinstance(b, dict):
+            yield from self._diff_dict(path, a, b)
+            return
+        if isinstance(a, list) and isinstance(b, list):
+            named_a = _to_named_dict(a)
+            named_b = _to_named_dict(b)
+            if named_a is not None and named_b is not None:
+                yield from self._diff_dict(path, named_a, named_b)
+                return
+            if len(a) == len(b):
+                yield from self._diff_dict(path, dict(enumerate(a)), dict(enumerate(b)))
+                return
+        yield "      ~ {path}: {a} -> {b}".format(path=path, a=self._format(a), b=self._format(b))
+
+    def _diff_dict(self, path: str, a: dict, b: dict):
+        for k, v in a.items():
+            if k not in b:
+                yield "      - {path}: {v}".format(path=_join(path, k), v=self._format(v))
+        for k, v in b.items():
+            if k not in a:
+                yield "      + {path}: {v}".format(path=_join(path, k), v=self._format(v))
+            else:
+                yield from self._diff_value(_join(path, k), a[k], v)
+
+    def _format(self, value) -> str:
+        text = json.dumps(value, sort_keys=True, default=str)
+        if len(text) > self.max_value_length:
+            text = text[:self.max_value_length] + '...'
+        return text
+
+
+def _to_named_dict(items: list):
+    """
+    {name: item} when every item is a dict with a unique `name`, else None
+    """
+    d = {}
+    for item in items:
+        if not isinstance(item, dict) or 'name' not in item or item['name'] in d:
+            return None
+        d[item['name']] = item
+    return d
+
+
+def _join(path: str, key) -> str:
+    if path == '':
+        return str(key)
+    return "{path}.{key}".format(path=path, key=key)
@@ -0,0 +1,60 @@
+# coding: utf-8
+import copy
+from threading import Lock
+
+
+class SharedDiscovery(object):
+    """
+    Clusters, services, cloudwatch event rules and their task definitions read once and shared by the deploys of
+    several environments. The descriptions are kept as returned by the api, so every deploy applies its own scope to
+    them.
+    """
+    def __init__(self, awsutils):
+        self.awsutils = awsutils
+        self.lock = Lock()
+        self.cluster_list = None
+        self.cluster_services = {}
+        self.rules = None
+        self.task_definitions = {}
+        self.task_definition_locks = {}
+
+    def list_clusters(self) -> list:
+        with self.lock:
+            if self.cluster_list is None:
+                self.cluster_list = self.awsutils.list_clusters()
+            return list(self.cluster_list)
+
+    def describe_services(self, cluster_list: list) -> list:
+        """
+        :return: service descriptions of the clusters
+        """
+        descriptions = []
+        with self.lock:
+            for cluster_name in cluster_list:
+                if cluster_name not in self.cluster_services:
+                    running_service_arn_list = self.awsutils.list_services(cluster_name)
+                    self.cluster_services[cluster_name] = \
+                        self.awsutils.describe_services(cluster_name, running_service_arn_list)
+                descriptions.extend(self.cluster_services[cluster_name])
+        return descriptions
+
+    def list_cloudwatch_event_rules(self) -> list:
+        with self.lock:
+            if self.rules is None:
+                self.rules = self.awsutils.list_cloudwatch_event_rules()
+            return list(self.rules)
+
+    def describe_task_definition(self, awsutils, name: str) -> dict:
+        """
+        :param name: task definition arn of a service, or family of a rule
+        :return: copy of the task definition, described once for all the environments
+        """
+        # 他のタスク定義の取得を待たせないように、名前ごとにlockする
+        with self.lock:
+            name_lock = self.task_definition_locks.setdefault(name, Lock())
+        with name_lock:
+            task_definition = self.task_definitions.get(name)
+            if task_definition is None:
+                task_definition = awsutils.describe_task_definition(name)
+                self.task_definitions[name] = task_definition
+        return copy.deepcopy(task_definition)
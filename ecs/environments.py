@@ -0,0 +1,56 @@
+# coding: utf-8
+import yaml
+import yamlordereddictloader
+
+from aws import AwsUtils, Throttle
+from ecs.classes import ParameterInvalidException
+from ecs.deploy import DeployManager, get_deploy_list
+from ecs.discovery import SharedDiscovery
+from ecs.shard import parse_shard
+from ecs.targets import ManagerDeploy, run_deploys
+
+
+def deploy_environments(args):
+    """
+    Deploy services.yml to several environments from one process.
+    services.yml is parsed once, the compiled templates and the clusters, services and rules read from ECS
+    are shared, and each environment is deployed concurrently by its own DeployManager.
+    """
+    services_config = yaml.load(args.services_yaml, Loader=yamlordereddictloader.Loader)
+    base_services_config = None
+    if args.base_services_yaml is not None:
+        base_services_config = yaml.load(args.base_services_yaml, Loader=yamlordereddictloader.Loader)
+    shard = parse_shard(args.shard) if args.shard is not None else None
+
+    # 全環境のrenderが通ってからデプロイを始める
+    rendered_list = []
+    for environment_yaml in args.environment_yaml_list:
+        rendered_list.append(get_deploy_list(
+            services_yaml=None,
+            environment_yaml=environment_yaml,
+            task_definition_template_dir=None,
+            task_definition_config_json=None,
+            task_definition_config_env=args.task_definition_config_env,
+            deploy_service_group=args.deploy_service_group,
+            template_group=args.template_group,
+            is_detach_service_metadata=args.detach_service_metadata,
+            render_cache_dir=args.render_cache_dir,
+            shard=shard,
+            services_config=services_config,
+            base_services_config=base_services_config
+        ))
+    environments = [x[4] for x in rendered_list]
+    if len(set(environments)) != len(environments):
+        raise ParameterInvalidException("environments must not be duplicated.")
+
+    # 同じアカウントとリージョンなので、APIの予算も共有する
+    throttle = Throttle(concurrency=args.api_concurrency)
+    discovery = SharedDiscovery(AwsUtils(access_key=args.key, secret_key=args.secret, region=args.region,
+                                         throttle=throttle))
+    threads = []
+    for rendered in rendered_list:
+        environment = rendered[4]
+        manager = DeployManager(args, rendered=rendered, file_suffix='.' + environment, discovery=discovery,
+                                throttle=throttle)
+        threads.append(ManagerDeploy(name=environment, manager=manager, is_dry_run=args.dry_run))
+    run_deploys(threads)
@@ -0,0 +1,70 @@
+# coding: utf-8
+import json
+import os
+from threading import Lock
+from time import time
+
+# デプロイ中のサービスにかかる時間
+deploy_phases = ('register', 'update', 'stable')
+
+
+class DeployHistory(object):
+    """
+    Durations of the past deploys per service and phase (register, update, stable, stop), kept in a local json file.
+    Without a path it only records the current run.
+    """
+    def __init__(self, path: str=None, max_samples: int=10):
+        self.path = path
+        self.max_samples = max_samples
+        self.lock = Lock()
+        self.durations = {}
+        self.started = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.durations = json.load(f).get('services', {})
+
+    def record(self, name: str, phase: str, seconds: float):
+        with self.lock:
+            samples = self.durations.setdefault(name, {}).setdefault(phase, [])
+            samples.append(round(seconds, 1))
+            del samples[:-self.max_samples]
+
+    def start(self, name: str, phase: str):
+        with self.lock:
+            self.started[(name, phase)] = time()
+
+    def is_started(self, name: str, phase: str) -> bool:
+        with self.lock:
+            return (name, phase) in self.started
+
+    def finish(self, name: str, phase: str):
+        with self.lock:
+            started = self.started.pop((name, phase), None)
+        if started is not None:
+            self.record(name, phase, time() - started)
+
+    def expected(self, name: str, phases: tuple=deploy_phases) -> float:
+        """
+        Expected seconds of the phases: the sum of the median of the recorded durations
+        """
+        with self.lock:
+            durations = self.durations.get(name, {})
+            seconds = 0
+            for phase in phases:
+                samples = sorted(durations.get(phase, []))
+                if len(samples) > 0:
+                    seconds += samples[len(samples) // 2]
+            return seconds
+
+    def has_records(self) -> bool:
+        return len(self.durations) > 0
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps({'services': self.durations}, indent=2, sort_keys=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
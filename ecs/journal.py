@@ -0,0 +1,65 @@
+# coding: utf-8
+import json
+import os
+from threading import Lock
+from time import time
+
+
+class DeployJournal(object):
+    """
+    Steps completed by a deploy (register, stop, update, stable, deregister), appended to a local json lines file
+    as soon as each one is done. A resumed deploy reads the steps of the previous run of the same environment
+    and keeps appending to the same file. Without a path nothing is recorded.
+    """
+    def __init__(self, path: str=None, environment: str=None, is_resume: bool=False):
+        self.path = path
+        self.lock = Lock()
+        self.steps = {}
+        if path is None:
+            return
+        if is_resume and os.path.exists(path):
+            entries = []
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # 途中で落ちた時の書きかけの行
+                        continue
+            if len(entries) > 0 and entries[0].get('environment') == environment:
+                for entry in entries[1:]:
+                    self.steps[(entry['name'], entry['step'])] = entry
+                return
+        with open(path, 'w') as f:
+            f.write(json.dumps({'environment': environment, 'time': time()}) + '\n')
+
+    def record(self, name: str, step: str, **values):
+        entry = dict(values, name=name, step=step, time=time())
+        with self.lock:
+            self.steps[(name, step)] = entry
+            if self.path is None:
+                return
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, name: str, step: str) -> dict:
+        with self.lock:
+            return self.steps.get((name, step))
+
+    def is_done(self, name: str, step: str, task_definition_arn: str, fingerprint: str) -> bool:
+        """
+        True if the step was completed with the task definition running now, rendered from the same config
+        """
+        entry = self.get(name, step)
+        return entry is not None and entry.get('arn') is not None and entry['arn'] == task_definition_arn \
+            and entry.get('fingerprint') == fingerprint
+
+    def has_steps(self) -> bool:
+        return len(self.steps) > 0
+
+    def finish(self):
+        # 最後まで終わったら次の--resumeでは最初から
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
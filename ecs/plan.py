@@ -0,0 +1,201 @@
+# coding: utf-8
+import json
+import os
+
+import ecs.service
+from ecs.scheduled_tasks import ScheduledTask, CloudwatchEventRule, scheduled_task_managed_description
+from ecs.utils import task_definition_fingerprint
+
+# planの形式を変えたら上げる
+plan_version = 1
+
+
+def _service_description(service_name: str, cluster_name: str, task_definition_arn: str,
+                         running_count: int, desired_count: int, service_exists: bool) -> dict:
+    # describe_servicesのレスポンスのうちDescribeServiceが読む値
+    return {
+        'serviceName': service_name,
+        'clusterArn': cluster_name,
+        'taskDefinition': task_definition_arn,
+        'runningCount': running_count,
+        'desiredCount': desired_count,
+        'status': 'ACTIVE' if service_exists else 'INACTIVE',
+    }
+
+
+def service_to_plan(service: ecs.service.Service) -> dict:
+    origin = None
+    if service.origin_task_definition_arn is not None:
+        origin = {
+            'description': _service_description(
+                service_name=service.service_name,
+                cluster_name=service.task_environment.cluster_name,
+                task_definition_arn=service.origin_task_definition_arn,
+                running_count=service.running_count,
+                desired_count=service.origin_desired_count,
+                service_exists=service.origin_service_exists
+            ),
+            'task_definition': service.origin_task_definition,
+        }
+    return {
+        'parameters': {
+            'task_definition': service.task_definition,
+            'stop_before_deploy': service.stop_before_deploy,
+            'primary_placement': service.is_primary_placement,
+            'placement_strategy': service.placement_strategy,
+            'placement_constraints': service.placement_constraints,
+            'load_balancers': service.load_balancers,
+            'network_configuration': service.network_configuration,
+            'service_registries': service.service_registries,
+            'metadata': service.metadata,
+            'config_name': service.config_name,
+        },
+        'fingerprint': task_definition_fingerprint(service.task_definition),
+        'task_definition_arn': service.task_definition_arn,
+        'origin': origin,
+    }
+
+
+def service_from_plan(data: dict) -> ecs.service.Service:
+    service = ecs.service.Service(**data['parameters'])
+    origin = data['origin']
+    if origin is not None:
+        describe_service = ecs.service.DescribeService(service_description=origin['description'])
+        if origin['task_definition'] is not None:
+            describe_service.set_from_task_definition(origin['task_definition'])
+        service.set_from_describe_service(describe_service=describe_service)
+    service.task_definition_arn = data['task_definition_arn']
+    return service
+
+
+def scheduled_task_to_plan(scheduled_task: ScheduledTask) -> dict:
+    origin = None
+    if scheduled_task.task_exists:
+        origin = {
+            'rule': {
+                'Arn': None,
+                'Name': scheduled_task.name,
+                'State': scheduled_task.state.value,
+                'Description': scheduled_task_managed_description,
+                'ScheduleExpression': scheduled_task.origin_schedule_expression,
+            },
+            'task_definition': scheduled_task.origin_task_definition,
+        }
+    return {
+        'parameters': {
+            'task_definition': scheduled_task.task_definition,
+            'target_lambda_arn': scheduled_task.target_lambda_arn,
+            'schedule_expression': scheduled_task.schedule_expression,
+            'placement_strategy': scheduled_task.placement_strategy,
+            'placement_constraints': scheduled_task.placement_constraints,
+            'events_role_arn': scheduled_task.events_role_arn,
+            'config_name': scheduled_task.config_name,
+            'network_configuration': scheduled_task.network_configuration,
+        },
+        'fingerprint': task_definition_fingerprint(scheduled_task.task_definition),
+        'task_definition_arn': scheduled_task.task_definition_arn,
+        'origin': origin,
+    }
+
+
+def scheduled_task_from_plan(data: dict) -> ScheduledTask:
+    scheduled_task = ScheduledTask(**data['parameters'])
+    origin = data['origin']
+    if origin is not None:
+        rule = CloudwatchEventRule(origin['rule'])
+        rule.set_from_task_definition(origin['task_definition'])
+        scheduled_task.set_from_cloudwatch_event_rule(rule)
+    scheduled_task.task_definition_arn = data['task_definition_arn']
+    return scheduled_task
+
+
+def describe_service_to_plan(describe_service: ecs.service.DescribeService) -> dict:
+    return _service_description(
+        service_name=describe_service.service_name,
+        cluster_name=describe_service.cluster_name,
+        task_definition_arn=describe_service.task_definition_arn,
+        running_count=describe_service.running_count,
+        desired_count=describe_service.desired_count,
+        service_exists=describe_service.service_exists
+    )
+
+
+def cloudwatch_event_rule_to_plan(rule: CloudwatchEventRule) -> dict:
+    return {
+        'rule': {
+            'Arn': rule.arn,
+            'Name': rule.name,
+            'State': rule.state.value,
+            'Description': rule.description,
+            'ScheduleExpression': rule.scheduled_expression,
+        },
+        'task_definition': rule.task_definition,
+    }
+
+
+def cloudwatch_event_rule_from_plan(data: dict) -> CloudwatchEventRule:
+    rule = CloudwatchEventRule(data['rule'])
+    rule.set_from_task_definition(data['task_definition'])
+    return rule
+
+
+def get_planned_services(plan: dict) -> dict:
+    """
+    Services the plan read from ECS, to check that they did not change before apply
+    :param plan: the plan
+    :return: cluster name -> service name -> description when planned, None if the service did not exist
+    """
+    clusters = {}
+    for data in plan['services']:
+        cluster_name = ecs.service.TaskEnvironment(
+            data['parameters']['task_definition'], metadata=data['parameters']['metadata']).cluster_name
+        service_name = data['parameters']['task_definition']['family'] + '-service'
+        origin = data['origin']
+        clusters.setdefault(cluster_name, {})[service_name] = None if origin is None else origin['description']
+    for description in plan['delete_services']:
+        clusters.setdefault(description['clusterArn'], {})[description['serviceName']] = description
+    return clusters
+
+
+def get_stale_services(awsutils, plan: dict) -> list:
+    """
+    Compare the services in the plan with ECS, one describe_services per cluster and 10 services
+    :param awsutils: AwsUtils
+    :param plan: the plan
+    :return: list of messages, empty if the plan is up to date
+    """
+    messages = []
+    for cluster_name, planned_services in sorted(get_planned_services(plan).items()):
+        res_services = awsutils.find_services(cluster_name, sorted(planned_services.keys()))
+        for service_name, planned in sorted(planned_services.items()):
+            res_service = res_services.get(service_name)
+            is_active = res_service is not None and res_service['status'] == 'ACTIVE'
+            if planned is None or planned['status'] != 'ACTIVE':
+                if is_active:
+                    messages.append("Service '{service_name}' was created in cluster '{cluster_name}'."
+                                    .format(service_name=service_name, cluster_name=cluster_name))
+                continue
+            if not is_active:
+                messages.append("Service '{service_name}' is no longer active in cluster '{cluster_name}'."
+                                .format(service_name=service_name, cluster_name=cluster_name))
+            elif res_service['taskDefinition'] != planned['taskDefinition']:
+                messages.append("Service '{service_name}' task definition changed: {planned} -> {current}"
+                                .format(service_name=service_name, planned=planned['taskDefinition'],
+                                        current=res_service['taskDefinition']))
+    return messages
+
+
+def save_plan(path: str, plan: dict):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_plan(path: str) -> dict:
+    with open(path, 'r') as f:
+        plan = json.load(f)
+    if plan.get('version') != plan_version:
+        raise Exception("Plan version {version} is not supported. create the plan again."
+                        .format(version=plan.get('version')))
+    return plan
@@ -0,0 +1,79 @@
+# coding: utf-8
+import hashlib
+import json
+import os
+
+from ecs.dependency import DependencyIndex, deploy_names
+
+# キャッシュの形式を変えたら上げる
+render_cache_version = 3
+
+
+class RenderCache(object):
+    """
+    Rendered services and scheduled tasks on disk.
+    The key is a hash of everything the rendering reads: the entry config, its environment config,
+    the template it uses, and the environment config values and environment variables referenced by them.
+    Entries hold the rendered container environment, secrets included, so the files are only readable by the owner.
+    """
+    def __init__(self, cache_dir: str, services_config: dict, environment_config: dict, environment: str,
+                 is_task_definition_config_env: bool, options: dict=None):
+        self.cache_dir = cache_dir
+        self.services_config = services_config
+        self.environment_config = environment_config
+        self.environment = environment
+        self.is_task_definition_config_env = is_task_definition_config_env
+        self.options = options or {}
+        # 環境設定のうちエントリが参照している値だけをキーに入れる
+        self.dependency_index = DependencyIndex(services_config, environment_config)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    def key(self, deploy_name: str, name: str) -> str:
+        base_config = self.services_config[deploy_name].get(name)
+        environment_entry_config = (self.environment_config.get(deploy_name) or {}).get(name) or {}
+        template_name = environment_entry_config.get('taskDefinitionTemplate',
+                                                     (base_config or {}).get('taskDefinitionTemplate'))
+        template = self.services_config.get('taskDefinitionTemplates', {}).get(template_name)
+        variables = self.dependency_index.entries.get((deploy_name, name), set())
+        environment_values = {x: self.environment_config[x] for x in variables
+                              if x in self.environment_config and x not in deploy_names}
+        environ = {}
+        if self.is_task_definition_config_env:
+            for variable in variables:
+                environ[variable] = os.environ.get(variable)
+        data = json.dumps({
+            'version': render_cache_version,
+            'deploy_name': deploy_name,
+            'name': name,
+            'environment': self.environment,
+            'options': self.options,
+            'config': base_config,
+            'environment_config': environment_entry_config,
+            'environment_values': environment_values,
+            'template': template,
+            'environ': environ,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), 'r') as f:
+                value = json.load(f)
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: dict):
+        tmp_path = self._path(key) + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key))
@@ -0,0 +1,108 @@
+# coding: utf-8
+import hashlib
+import re
+
+rate_pattern = re.compile(r'^rate\((\d+) (minute|minutes|hour|hours)\)$')
+cron_pattern = re.compile(r'^cron\((.+)\)$')
+minute_step_pattern = re.compile(r'^(\*|\d+)/(\d+)$')
+
+
+def family_offset(family: str) -> int:
+    # 実行ごとに変わらないようにfamilyのhashから決める
+    return int(hashlib.sha256(family.encode('utf-8')).hexdigest(), 16)
+
+
+def stagger_schedule_expression(schedule_expression: str, family: str, window: int) -> str:
+    """
+    Shift the start minute of the schedule by a per-family offset smaller than `window` minutes.
+    rate() expressions that divide an hour or a day are rewritten to the equivalent cron().
+    Expressions that cannot be shifted without changing their period are returned as is.
+    :param schedule_expression: cloudwatch event schedule expression
+    :param family: task definition family
+    :param window: max offset in minutes
+    :return: schedule expression
+    """
+    if window <= 1:
+        return schedule_expression
+    offset = family_offset(family)
+
+    m = rate_pattern.match(schedule_expression)
+    if m:
+        value = int(m.group(1))
+        if m.group(2).startswith('minute'):
+            if value <= 1 or 60 % value != 0:
+                return schedule_expression
+            return "cron({minute}/{value} * * * ? *)".format(minute=offset % min(value, window), value=value)
+        if 24 % value != 0:
+            return schedule_expression
+        minute = offset % min(60, window)
+        if value == 1:
+            return "cron({minute} * * * ? *)".format(minute=minute)
+        return "cron({minute} 0/{value} * * ? *)".format(minute=minute, value=value)
+
+    m = cron_pattern.match(schedule_expression)
+    if not m:
+        return schedule_expression
+    fields = m.group(1).split()
+    if len(fields) != 6:
+        return schedule_expression
+    minute_field = fields[0]
+    if minute_field.isdigit():
+        minute = int(minute_field)
+        # 時間をまたがない範囲でずらす
+        fields[0] = str(minute + offset % min(window, 60 - minute))
+    else:
+        step = minute_step_pattern.match(minute_field)
+        if not step:
+            return schedule_expression
+        value = int(step.group(2))
+        start = 0 if step.group(1) == '*' else int(step.group(1))
+        if value <= 1 or start >= value:
+            return schedule_expression
+        fields[0] = "{minute}/{value}".format(minute=(start + offset % min(window, value)) % value, value=value)
+    return "cron({fields})".format(fields=' '.join(fields))
+
+
+def get_schedule_minutes(schedule_expression: str) -> list:
+    """
+    Minutes of the hour the schedule starts at. rate() is assumed to start at minute 0.
+    :param schedule_expression: cloudwatch event schedule expression
+    :return: list of minutes, empty if unknown
+    """
+    m = rate_pattern.match(schedule_expression)
+    if m:
+        value = int(m.group(1))
+        if m.group(2).startswith('minute'):
+            return list(range(0, 60, value))
+        return [0]
+    m = cron_pattern.match(schedule_expression)
+    if not m:
+        return []
+    minute_field = m.group(1).split()[0]
+    minutes = set()
+    for part in minute_field.split(','):
+        step = minute_step_pattern.match(part)
+        if part == '*':
+            minutes.update(range(60))
+        elif part.isdigit():
+            minutes.add(int(part))
+        elif step:
+            start = 0 if step.group(1) == '*' else int(step.group(1))
+            minutes.update(range(start, 60, int(step.group(2))))
+        elif re.match(r'^\d+-\d+$', part):
+            first, last = part.split('-')
+            minutes.update(range(int(first), int(last) + 1))
+    return sorted(minutes)
+
+
+def get_minute_histogram(scheduled_task_list: list) -> dict:
+    """
+    Number of tasks started at each minute of the hour
+    :param scheduled_task_list: list of ScheduledTask
+    :return: minute -> task count
+    """
+    histogram = {}
+    for scheduled_task in scheduled_task_list:
+        for minute in get_schedule_minutes(scheduled_task.schedule_expression):
+            histogram[minute] = histogram.get(minute, 0) + scheduled_task.task_environment.task_count
+    return histogram
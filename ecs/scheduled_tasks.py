@@ -4,13 +4,14 @@ import logging
 import copy
 import jinja2
 import enum
-from datadiff import diff
-from distutils.util import strtobool
 
 import ecs.classes
 import render
-from ecs.utils import adjust_container_definition, is_same_container_definition, get_variables
-from ecs.classes import Deploy, DeployTargetType
+from ecs.diff import ContainerDefinitionDiff
+from ecs.schedule import stagger_schedule_expression
+from ecs.utils import adjust_container_definition, is_same_container_definition, get_variables, strtobool, \
+    task_definition_fingerprint
+from ecs.classes import Deploy, DeployScope, DeployTargetType
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +48,9 @@ class CloudWatchEventState(enum.Enum):
 
 
 class TaskEnvironment(object):
+    __slots__ = ('environment', 'cluster_name', 'service_group', 'template_group', 'task_count',
+                 'placement_strategy', 'placement_constraints', 'target_lambda_arn', 'events_role_arn')
+
     def __init__(self, task_definition: dict) -> None:
         try:
             task_environment_list = task_definition['containerDefinitions'][0]['environment']
@@ -55,26 +59,18 @@ class TaskEnvironment(object):
                 "task definition is lack of environment.\ntask definition:\n{task_definition}"
                 .format(task_definition=task_definition))
 
-        self.environment = None
-        self.cluster_name = None
-        self.service_group = None
-        self.template_group = None
+        values = {x['name']: x['value'] for x in task_environment_list}
+        self.environment = values.get('ENVIRONMENT')
+        self.cluster_name = values.get('CLUSTER_NAME')
+        self.service_group = values.get('SERVICE_GROUP')
+        self.template_group = values.get('TEMPLATE_GROUP')
         self.task_count = None
         self.placement_strategy = None
         self.placement_constraints = None
-        for task_environment in task_environment_list:
-            if task_environment['name'] == 'ENVIRONMENT':
-                self.environment = task_environment['value']
-            if task_environment['name'] == 'CLUSTER_NAME':
-                self.cluster_name = task_environment['value']
-            elif task_environment['name'] == 'SERVICE_GROUP':
-                self.service_group = task_environment['value']
-            elif task_environment['name'] == 'TEMPLATE_GROUP':
-                self.template_group = task_environment['value']
-            elif task_environment['name'] == 'TASK_COUNT':
-                self.task_count = int(task_environment['value'])
-            elif task_environment['name'] == 'TARGET_LAMBDA_ARN':
-                self.target_lambda_arn = task_environment['value']
+        self.target_lambda_arn = values.get('TARGET_LAMBDA_ARN')
+        self.events_role_arn = values.get('EVENTS_ROLE_ARN')
+        if 'TASK_COUNT' in values:
+            self.task_count = int(values['TASK_COUNT'])
         if self.environment is None:
             raise EnvironmentValueNotFoundException(
                 "task definition is lack of environment `ENVIRONMENT`.\ntask definition:\n{task_definition}"
@@ -87,37 +83,48 @@ class TaskEnvironment(object):
             raise EnvironmentValueNotFoundException(
                 "task definition is lack of environment `TASK_COUNT`.\ntask definition:\n{task_definition}"
                 .format(task_definition=task_definition))
-        elif self.target_lambda_arn is None:
+        elif self.target_lambda_arn is None and self.events_role_arn is None:
             raise EnvironmentValueNotFoundException(
                 "task definition is lack of environment `TARGET_LAMBDA_ARN`.\ntask definition:\n{task_definition}"
                 .format(task_definition=task_definition))
 
 
 class CloudwatchEventRule(Deploy):
-    def __init__(self, rule: dict):
-        self.name = rule['Name']
+    __slots__ = ('arn', 'state', 'description', 'scheduled_expression', 'task_definition', 'task_definition_arn',
+                 'task_definition_fingerprint', 'task_environment', 'family', 'scope')
+
+    def __init__(self, rule: dict, scope: DeployScope=None):
         self.arn = rule['Arn']
         self.state = CloudWatchEventState.get_state(rule['State'])
         self.description = rule['Description']
         self.scheduled_expression = rule['ScheduleExpression']
+        self.scope = scope
 
         self.task_definition = None
         self.task_definition_arn = None
+        self.task_definition_fingerprint = None
         self.task_environment = None
         self.family = None
 
-        super().__init__(self.name, target_type=DeployTargetType.scheduled_task)
+        super().__init__(rule['Name'], target_type=DeployTargetType.scheduled_task)
 
     def set_from_task_definition(self, task_definition: dict):
-        self.task_definition = task_definition
         self.task_definition_arn = task_definition.get('taskDefinitionArn')
         self.task_environment = TaskEnvironment(task_definition)
         self.family = task_definition['family']
+        # スコープ外のルールはタスク定義を保持しない
+        if self.scope is None or self.scope.contains(self.task_environment):
+            self.task_definition = task_definition
+        else:
+            self.task_definition_fingerprint = task_definition_fingerprint(task_definition)
 
 
 class ScheduledTask(Deploy):
-    def __init__(self, task_definition, target_lambda_arn, schedule_expression, placement_strategy, placement_constraints):
+    def __init__(self, task_definition, target_lambda_arn, schedule_expression, placement_strategy, placement_constraints,
+                 events_role_arn=None, config_name=None, network_configuration=None):
         self.task_definition = task_definition
+        # services.ymlでの名前
+        self.config_name = config_name
         self.family = task_definition.get('family')
         if self.family is None:
             raise EnvironmentValueNotFoundException(
@@ -126,9 +133,12 @@ class ScheduledTask(Deploy):
 
         self.task_environment = TaskEnvironment(task_definition)
         self.target_lambda_arn = target_lambda_arn
+        # roleArnがあればlambdaを経由せずにルールから直接タスクを起動する
+        self.events_role_arn = events_role_arn
         self.schedule_expression = schedule_expression
         self.placement_strategy = placement_strategy
         self.placement_constraints = placement_constraints
+        self.network_configuration = network_configuration
 
         self.status = ecs.classes.ProcessStatus.normal
 
@@ -137,6 +147,7 @@ class ScheduledTask(Deploy):
         self.origin_task_definition_arn = None
         self.origin_task_definition = None
         self.origin_task_environment = None
+        self.origin_schedule_expression = None
         self.task_definition_arn = None
 
         super().__init__(self.family, target_type=DeployTargetType.scheduled_task)
@@ -145,20 +156,42 @@ class ScheduledTask(Deploy):
         self.origin_task_definition = cloudwatch_event_rule.task_definition
         self.origin_task_definition_arn = cloudwatch_event_rule.task_definition_arn
         self.origin_task_environment = cloudwatch_event_rule.task_environment
+        self.origin_schedule_expression = cloudwatch_event_rule.scheduled_expression
         self.state = cloudwatch_event_rule.state
         self.task_exists = True
 
-    def compare_container_definition(self):
+    def is_unchanged(self) -> bool:
+        """
+        True if the rule, its target and the task definition are already deployed as is.
+        The state is taken over from the rule, so only the schedule and the target are compared.
+        """
+        if not self.task_exists:
+            return False
+        if self.schedule_expression != self.origin_schedule_expression:
+            return False
+        if self.target_lambda_arn != self.origin_task_environment.target_lambda_arn:
+            return False
+        if self.events_role_arn != self.origin_task_environment.events_role_arn:
+            return False
+        return self.is_same_task_definition()
+
+    def is_ecs_target(self) -> bool:
+        return self.events_role_arn is not None
+
+    def compare_container_definition(self, is_show_diff: bool=True):
         if self.is_same_task_definition():
             self.task_definition_arn = self.origin_task_definition_arn
             return "    - Container Definition is not changed."
         else:
-            ad = adjust_container_definition(self.origin_task_definition['containerDefinitions'])
-            bd = adjust_container_definition(self.task_definition['containerDefinitions'])
-            t = diff(ad, bd)
+            if not is_show_diff:
+                return "    - Container is changed."
+            t = ContainerDefinitionDiff(self.origin_task_definition['containerDefinitions'],
+                                        self.task_definition['containerDefinitions'])
             return "    - Container is changed. Diff:\n{t}".format(t=t)
 
     def is_same_task_definition(self):
+        if self.origin_task_definition is None:
+            return False
         ad = adjust_container_definition(self.origin_task_definition['containerDefinitions'])
         bd = adjust_container_definition(self.task_definition['containerDefinitions'])
         return is_same_container_definition(ad, bd)
@@ -181,7 +214,8 @@ def get_deploy_scheduled_task_list(task_list, deploy_service_group, template_gro
 def get_scheduled_task_list(services_config,
                             environment_config,
                             is_task_definition_config_env: bool,
-                            environment):
+                            environment,
+                            render_cache=None):
     try:
         scheduled_tasks = services_config["scheduledTasks"]
     except KeyError:
@@ -194,6 +228,15 @@ def get_scheduled_task_list(services_config,
         if task_name in scheduled_task_list:
             raise Exception("'%s' is duplicate task." % task_name)
         scheduled_task_name_list.append(task_name)
+        # 入力が変わっていなければrenderしない
+        cache_key = None
+        if render_cache is not None:
+            cache_key = render_cache.key('scheduledTasks', task_name)
+            cached = render_cache.get(cache_key)
+            if cached is not None:
+                if not cached.get('disabled'):
+                    scheduled_task_list.append(ScheduledTask(**cached))
+                continue
         # 設定値と変数を取得
         task_config, variables = get_variables(
             deploy_name = 'scheduledTasks',
@@ -245,7 +288,7 @@ def get_scheduled_task_list(services_config,
                 placement_strategy_list.append(strategy)
             env.append({"name": "PLACEMENT_STRATEGY", "value": str(placement_strategy)})
 
-        placement_constraints = service_config.get("placementConstraints")
+        placement_constraints = task_config.get("placementConstraints")
         placement_constraints_list = None
         if placement_constraints is not None:
             placement_constraints_list = []
@@ -255,6 +298,19 @@ def get_scheduled_task_list(services_config,
                 placement_constraints_list.append(constrant)
             env.append({"name": "PLACEMENT_CONSTRAINTS", "value": str(placement_constraints)})
 
+        network_configuration = task_config.get("networkConfiguration")
+        rendered_network_configuration = None
+        if network_configuration is not None:
+            network_configuration_data = render.render_template(json.dumps(network_configuration), variables,
+                                                                is_task_definition_config_env)
+            try:
+                rendered_network_configuration = json.loads(network_configuration_data)
+            except json.decoder.JSONDecodeError as e:
+                raise Exception(
+                    "Scheduled Task `{task_name}` networkConfiguration: {e.__class__.__name__} {e}\njson:\n{json}"
+                    .format(task_name=task_name, e=e, json=network_configuration_data))
+            env.append({"name": "NETWORK_CONFIGURATION", "value": str(network_configuration)})
+
         cloudwatch_event = task_config.get('cloudwatchEvent')
         if cloudwatch_event is None:
             raise ParameterNotFoundException("Scheduled Task `{task_name}` requires parameter `cloudwatchEvent`"
@@ -269,14 +325,31 @@ def get_scheduled_task_list(services_config,
             variables,
             is_task_definition_config_env
         )
+        stagger_minutes = cloudwatch_event.get("staggerMinutes")
+        if stagger_minutes is not None:
+            stagger_minutes = render.render_template(str(stagger_minutes), variables, is_task_definition_config_env)
+            try:
+                stagger_minutes = int(stagger_minutes)
+            except ValueError:
+                raise ParameterInvalidException("Scheduled Task `{task_name}` parameter "
+                                                "`cloudwatchEvent.staggerMinutes` is int"
+                                                .format(task_name=task_name))
 
-        target_lambda_arn = cloudwatch_event.get("targetLambdaArn")
-        if schedule_expression is None:
-            raise ParameterNotFoundException("Scheduled Task `{task_name}` requires parameter "
-                                             "`cloudwatchEvent.targetLambdaArn`"
-                                             .format(task_name=task_name))
-        target_lambda_arn = render.render_template(str(target_lambda_arn), variables, is_task_definition_config_env)
-        env.append({"name": "TARGET_LAMBDA_ARN", "value": target_lambda_arn})
+        # roleArnがあればECSタスクを直接ターゲットにする
+        events_role_arn = cloudwatch_event.get("roleArn")
+        target_lambda_arn = None
+        if events_role_arn is not None:
+            events_role_arn = render.render_template(str(events_role_arn), variables, is_task_definition_config_env)
+            env.append({"name": "EVENTS_ROLE_ARN", "value": events_role_arn})
+        else:
+            target_lambda_arn = cloudwatch_event.get("targetLambdaArn")
+            if target_lambda_arn is None:
+                raise ParameterNotFoundException("Scheduled Task `{task_name}` requires parameter "
+                                                 "`cloudwatchEvent.targetLambdaArn` or `cloudwatchEvent.roleArn`"
+                                                 .format(task_name=task_name))
+            target_lambda_arn = render.render_template(str(target_lambda_arn), variables,
+                                                       is_task_definition_config_env)
+            env.append({"name": "TARGET_LAMBDA_ARN", "value": target_lambda_arn})
 
         task_definition_template = task_config.get("taskDefinitionTemplate")
         if task_definition_template is None:
@@ -303,6 +376,26 @@ def get_scheduled_task_list(services_config,
                 "Scheduled Task `{task_name}`: {e.__class__.__name__} {e}\njson:\n{task_definition_data}"
                 .format(task_name=task_name, e=e, task_definition_data=task_definition_data))
 
+        if rendered_network_configuration is not None \
+                and rendered_network_configuration.get('awsvpcConfiguration') is not None:
+            task_definition.update({"networkMode": "awsvpc"})
+        if events_role_arn is not None:
+            # ルールから直接起動するので、起動に必要な設定がなければrenderで止める
+            compatibilities = task_definition.get('requiresCompatibilities') or []
+            if 'FARGATE' in compatibilities and 'EC2' not in compatibilities:
+                raise ParameterInvalidException("Scheduled Task `{task_name}` with `cloudwatchEvent.roleArn` must be "
+                                                "EC2 compatible. Fargate task definitions are not supported."
+                                                .format(task_name=task_name))
+            if task_definition.get('networkMode') == 'awsvpc' and rendered_network_configuration is None:
+                raise ParameterNotFoundException("Scheduled Task `{task_name}` with `cloudwatchEvent.roleArn` and "
+                                                 "awsvpc network mode requires parameter `networkConfiguration`"
+                                                 .format(task_name=task_name))
+
+        # 同じ時刻に集中しないように開始時刻をずらす
+        if stagger_minutes is not None and task_definition.get('family') is not None:
+            schedule_expression = stagger_schedule_expression(
+                schedule_expression, task_definition['family'], stagger_minutes)
+
         # set parameters to docker environment
         for container_definitions in task_definition.get("containerDefinitions"):
             task_environment = container_definitions.get("environment")
@@ -325,15 +418,22 @@ def get_scheduled_task_list(services_config,
                 raise ParameterInvalidException("Scheduled Task `{task_name}` parameter `disabled` must be bool"
                                                 .format(task_name=task_name))
             if disabled:
+                if cache_key is not None:
+                    render_cache.put(cache_key, {'disabled': True})
                 continue
 
-        scheduled_task = ScheduledTask(
+        scheduled_task_parameters = dict(
             task_definition=task_definition,
             target_lambda_arn=target_lambda_arn,
             schedule_expression=schedule_expression,
-            placement_strategy=placement_strategy,
-            placement_constraints=placement_constraints
+            placement_strategy=placement_strategy_list,
+            placement_constraints=placement_constraints_list,
+            events_role_arn=events_role_arn,
+            config_name=task_name,
+            network_configuration=rendered_network_configuration
         )
-        scheduled_task_list.append(scheduled_task)
+        if cache_key is not None:
+            render_cache.put(cache_key, scheduled_task_parameters)
+        scheduled_task_list.append(ScheduledTask(**scheduled_task_parameters))
 
     return scheduled_task_list
@@ -3,21 +3,24 @@ import json
 import logging
 import os
 import copy
-from distutils.util import strtobool
 
 import jinja2
-from datadiff import diff
 
 import render
-from ecs.classes import DeployTargetType, Deploy, EnvironmentValueNotFoundException, ParameterInvalidException, \
-    ParameterNotFoundException
-from ecs.utils import is_same_container_definition, adjust_container_definition, get_variables
+from ecs.classes import DeployTargetType, Deploy, DeployScope, EnvironmentValueNotFoundException, \
+    ParameterInvalidException, ParameterNotFoundException
+from ecs.diff import ContainerDefinitionDiff
+from ecs.utils import is_same_container_definition, adjust_container_definition, get_variables, strtobool, \
+    task_definition_fingerprint
 
 logger = logging.getLogger(__name__)
 
 
 class TaskEnvironment(object):
-    def __init__(self, task_definition: dict):
+    __slots__ = ('environment', 'cluster_name', 'service_group', 'template_group', 'desired_count',
+                 'is_downscale_task', 'minimum_healthy_percent', 'maximum_percent', 'distinct_instance')
+
+    def __init__(self, task_definition: dict, metadata: list=None):
         try:
             task_environment_list = task_definition['containerDefinitions'][0]['environment']
         except:
@@ -25,32 +28,24 @@ class TaskEnvironment(object):
                 "task definition is lack of environment.\ntask definition:\n{task_definition}"
                 .format(task_definition=task_definition))
 
-        self.environment = None
-        self.cluster_name = None
-        self.service_group = None
-        self.template_group = None
+        values = {x['name']: x['value'] for x in task_environment_list}
+        # コンテナの環境変数にないデプロイ設定はmetadataから補完する
+        if metadata is not None:
+            for x in metadata:
+                values.setdefault(x['name'], x['value'])
+        self.environment = values.get('ENVIRONMENT')
+        self.cluster_name = values.get('CLUSTER_NAME')
+        self.service_group = values.get('SERVICE_GROUP')
+        self.template_group = values.get('TEMPLATE_GROUP')
         self.desired_count = None
         self.is_downscale_task = None
-        self.minimum_healthy_percent = 50
-        self.maximum_percent = 200
+        self.minimum_healthy_percent = int(values.get('MINIMUM_HEALTHY_PERCENT', 50))
+        self.maximum_percent = int(values.get('MAXIMUM_PERCENT', 200))
         self.distinct_instance = False
-        for task_environment in task_environment_list:
-            if task_environment['name'] == 'ENVIRONMENT':
-                self.environment = task_environment['value']
-            if task_environment['name'] == 'CLUSTER_NAME':
-                self.cluster_name = task_environment['value']
-            elif task_environment['name'] == 'SERVICE_GROUP':
-                self.service_group = task_environment['value']
-            elif task_environment['name'] == 'TEMPLATE_GROUP':
-                self.template_group = task_environment['value']
-            elif task_environment['name'] == 'DESIRED_COUNT':
-                self.desired_count = int(task_environment['value'])
-            elif task_environment['name'] == 'MINIMUM_HEALTHY_PERCENT':
-                self.minimum_healthy_percent = int(task_environment['value'])
-            elif task_environment['name'] == 'MAXIMUM_PERCENT':
-                self.maximum_percent = int(task_environment['value'])
-            elif task_environment['name'] == 'DISTINCT_INSTANCE':
-                self.distinct_instance = bool(strtobool(task_environment['value']))
+        if 'DESIRED_COUNT' in values:
+            self.desired_count = int(values['DESIRED_COUNT'])
+        if 'DISTINCT_INSTANCE' in values:
+            self.distinct_instance = bool(strtobool(values['DISTINCT_INSTANCE']))
         if self.environment is None:
             raise EnvironmentValueNotFoundException(
                 "task definition is lack of environment `ENVIRONMENT`.\ntask definition:\n{task_definition}"
@@ -66,15 +61,21 @@ class TaskEnvironment(object):
 
 
 class DescribeService(Deploy):
-    def __init__(self, service_description: dict):
+    __slots__ = ('service_name', 'cluster_name', 'task_definition_arn', 'running_count', 'desired_count',
+                 'task_definition', 'task_definition_fingerprint', 'task_environment', 'family', 'service_exists',
+                 'tags', 'scope')
+
+    def __init__(self, service_description: dict, scope: DeployScope=None):
         self.service_name = service_description['serviceName']
-        self.cluster_arn = service_description['clusterArn']
-        self.cluster_name = arn_to_name(self.cluster_arn)
+        self.cluster_name = arn_to_name(service_description['clusterArn'])
         self.task_definition_arn = service_description['taskDefinition']
         self.running_count = service_description['runningCount']
         self.desired_count = service_description['desiredCount']
+        self.tags = {x['key']: x['value'] for x in service_description.get('tags', [])}
+        self.scope = scope
 
         self.task_definition = None
+        self.task_definition_fingerprint = None
         self.task_environment = None
         self.family = None
 
@@ -84,18 +85,34 @@ class DescribeService(Deploy):
 
         super().__init__(name=self.service_name, target_type=DeployTargetType.service_describe)
 
+    def is_tagged(self) -> bool:
+        # タグなしは以前のバージョンで作成されたサービス
+        return 'ENVIRONMENT' in self.tags
+
     def set_from_task_definition(self, task_definition: dict):
-        self.task_definition = task_definition
-        self.task_environment = TaskEnvironment(task_definition)
+        # --detach-service-metadataで登録したタスク定義にはDESIRED_COUNTがない
+        self.task_environment = TaskEnvironment(
+            task_definition, metadata=[{'name': 'DESIRED_COUNT', 'value': str(self.desired_count)}])
         self.family = task_definition['family']
+        # スコープ外のサービスはタスク定義を保持しない
+        if self.scope is None or self.scope.contains(self.task_environment):
+            self.task_definition = task_definition
+        else:
+            self.task_definition_fingerprint = task_definition_fingerprint(task_definition)
 
 
 class Service(Deploy):
     def __init__(self, task_definition: dict, stop_before_deploy: bool, primary_placement: bool,
                  placement_strategy: list = None, placement_constraints: list = None, load_balancers: list = None,
-                 network_configuration: dict = None, service_registries: list = None):
+                 network_configuration: dict = None, service_registries: list = None, metadata: list = None,
+                 config_name: str = None):
         self.task_definition = task_definition
-        self.task_environment = TaskEnvironment(task_definition)
+        # services.ymlでの名前
+        self.config_name = config_name
+        self.task_environment = TaskEnvironment(task_definition, metadata=metadata)
+        # metadataがタスク定義の外にあれば、タスク定義が同じ時はタスクを入れ替えない
+        self.metadata = metadata
+        self.is_detached_metadata = metadata is not None
         self.family = task_definition['family']
         self.service_name = self.family + '-service'
         self.desired_count = self.task_environment.desired_count
@@ -135,16 +152,17 @@ class Service(Deploy):
         if is_create_service:
             self.origin_desired_count = self.desired_count
 
-    def compare_container_definition(self):
+    def compare_container_definition(self, is_show_diff: bool=True):
         if self.is_same_task_definition():
             self.task_definition_arn = self.origin_task_definition_arn
             return "    - Container Definition is not changed."
         else:
             if self.origin_task_definition is None:
                 return "     - Origin Container Definition not available."
-            ad = adjust_container_definition(self.origin_task_definition.get('containerDefinitions'))
-            bd = adjust_container_definition(self.task_definition.get('containerDefinitions'))
-            t = diff(ad, bd)
+            if not is_show_diff:
+                return "    - Container is changed."
+            t = ContainerDefinitionDiff(self.origin_task_definition.get('containerDefinitions'),
+                                        self.task_definition.get('containerDefinitions'))
             return "    - Container is changed. Diff:\n{t}".format(t=t)
 
     def is_same_task_definition(self):
@@ -210,7 +228,9 @@ def get_service_list_yaml(
         services_config: dict,
         environment_config: dict,
         is_task_definition_config_env: bool,
-        environment: str
+        environment: str,
+        is_detach_service_metadata: bool=False,
+        render_cache=None
 ) -> list:
     try:
         services = services_config["services"]
@@ -225,6 +245,15 @@ def get_service_list_yaml(
         if service_name in service_name_list:
             raise Exception("'%s' is duplicate service." % service_name)
         service_name_list.append(service_name)
+        # 入力が変わっていなければrenderしない
+        cache_key = None
+        if render_cache is not None:
+            cache_key = render_cache.key('services', service_name)
+            cached = render_cache.get(cache_key)
+            if cached is not None:
+                if not cached.get('disabled'):
+                    service_list.append(Service(**cached))
+                continue
         # 設定値と変数を取得
         service_config, variables = get_variables(
             deploy_name = 'services',
@@ -236,6 +265,8 @@ def get_service_list_yaml(
 
         # parameter check & build docker environment
         env = [{"name": "ENVIRONMENT", "value": environment}]
+        # デプロイ設定 (desiredCountなど)
+        metadata = []
 
         registrator = service_config.get("registrator")
         if registrator is not None:
@@ -278,7 +309,7 @@ def get_service_list_yaml(
         except ValueError:
             raise ParameterInvalidException("Service `{service_name}` parameter `desiredCount` is int"
                                             .format(service_name=service_name))
-        env.append({"name": "DESIRED_COUNT", "value": desired_count})
+        metadata.append({"name": "DESIRED_COUNT", "value": desired_count})
 
         minimum_healthy_percent = service_config.get("minimumHealthyPercent")
         if minimum_healthy_percent is not None:
@@ -290,7 +321,7 @@ def get_service_list_yaml(
             except ValueError:
                 raise ParameterInvalidException("Service `{service_name}` parameter `minimumHealthyPercent` is int"
                                                 .format(service_name=service_name))
-            env.append({"name": "MINIMUM_HEALTHY_PERCENT", "value": minimum_healthy_percent})
+            metadata.append({"name": "MINIMUM_HEALTHY_PERCENT", "value": minimum_healthy_percent})
 
         maximum_percent = service_config.get("maximumPercent")
         if maximum_percent is not None:
@@ -301,7 +332,7 @@ def get_service_list_yaml(
                 raise ParameterInvalidException(
                     "Service `{service_name}` parameter `maximumPercent` is int".format(service_name=service_name)
                 )
-            env.append({"name": "MAXIMUM_PERCENT", "value": str(maximum_percent)})
+            metadata.append({"name": "MAXIMUM_PERCENT", "value": str(maximum_percent)})
 
         distinct_instance = service_config.get("distinctInstance")
         if distinct_instance is not None:
@@ -312,7 +343,7 @@ def get_service_list_yaml(
                 raise ParameterInvalidException("Service `{service_name}` parameter `distinctInstance` must be bool"
                                                 .format(service_name=service_name))
             if distinct_instance:
-                env.append({"name": "DISTINCT_INSTANCE", "value": "true"})
+                metadata.append({"name": "DISTINCT_INSTANCE", "value": "true"})
 
         placement_strategy = service_config.get("placementStrategy")
         placement_strategy_list = None
@@ -322,7 +353,7 @@ def get_service_list_yaml(
                 strategy = render.render_template(json.dumps(strategy), variables, is_task_definition_config_env)
                 strategy = json.loads(strategy)
                 placement_strategy_list.append(strategy)
-            env.append({"name": "PLACEMENT_STRATEGY", "value": str(placement_strategy)})
+            metadata.append({"name": "PLACEMENT_STRATEGY", "value": str(placement_strategy)})
 
         placement_constraints = service_config.get("placementConstraints")
         placement_constraints_list = None
@@ -332,7 +363,7 @@ def get_service_list_yaml(
                 constrant = render.render_template(json.dumps(constrant), variables, is_task_definition_config_env)
                 constrant = json.loads(constrant)
                 placement_constraints_list.append(constrant)
-            env.append({"name": "PLACEMENT_CONSTRAINTS", "value": str(placement_constraints)})
+            metadata.append({"name": "PLACEMENT_CONSTRAINTS", "value": str(placement_constraints)})
 
         primary_placement = service_config.get("primaryPlacement")
         if primary_placement is not None:
@@ -343,7 +374,7 @@ def get_service_list_yaml(
                 raise ParameterInvalidException("Service `{service_name}` parameter `primaryPlacement` must be bool"
                                                 .format(service_name=service_name))
             if primary_placement:
-                env.append({"name": "PRIMARY_PLACEMENT", "value": "true"})
+                metadata.append({"name": "PRIMARY_PLACEMENT", "value": "true"})
 
         task_definition_template = service_config.get("taskDefinitionTemplate")
         if task_definition_template is None:
@@ -414,7 +445,7 @@ def get_service_list_yaml(
                 d.update({"containerPort": container_port})
 
                 rendered_balancers.append(d)
-                env.append({"name": "LOAD_BALANCER", "value": "true"})
+                metadata.append({"name": "LOAD_BALANCER", "value": "true"})
 
         network_configuration = service_config.get("networkConfiguration")
         rendered_network_configuration = None
@@ -455,6 +486,12 @@ def get_service_list_yaml(
                                                                                             json=service_registry_data))
                 rendered_service_registries.append(rendered_service_registry)
 
+        service_metadata = None
+        if is_detach_service_metadata:
+            service_metadata = metadata
+        else:
+            env.extend(metadata)
+
         # set parameters to docker environment
         for container_definitions in task_definition.get("containerDefinitions"):
             task_environment = container_definitions.get("environment")
@@ -475,6 +512,8 @@ def get_service_list_yaml(
                 raise ParameterInvalidException("Service `{service_name}` parameter `disabled` must be bool"
                                                 .format(service_name=service_name))
             if disabled:
+                if cache_key is not None:
+                    render_cache.put(cache_key, {'disabled': True})
                 continue
 
         # stop before deploy
@@ -489,18 +528,21 @@ def get_service_list_yaml(
         else:
             stop_before_deploy = False
 
-        service_list.append(
-            Service(
-                task_definition=task_definition,
-                stop_before_deploy=stop_before_deploy,
-                primary_placement=primary_placement,
-                placement_strategy=placement_strategy_list,
-                placement_constraints=placement_constraints_list,
-                load_balancers=rendered_balancers,
-                network_configuration=rendered_network_configuration,
-                service_registries=rendered_service_registries,
-            )
+        service_parameters = dict(
+            task_definition=task_definition,
+            stop_before_deploy=stop_before_deploy,
+            primary_placement=primary_placement,
+            placement_strategy=placement_strategy_list,
+            placement_constraints=placement_constraints_list,
+            load_balancers=rendered_balancers,
+            network_configuration=rendered_network_configuration,
+            service_registries=rendered_service_registries,
+            metadata=service_metadata,
+            config_name=service_name,
         )
+        if cache_key is not None:
+            render_cache.put(cache_key, service_parameters)
+        service_list.append(Service(**service_parameters))
     return service_list
 
 
@@ -529,13 +571,16 @@ def __get_service_variables(service_name, base_service_config, environment_confi
     return service_config, variables
 
 
-def fetch_aws_service(cluster_list, awsutils) -> list:
-    l = []
+def fetch_aws_service(cluster_list, awsutils, scope: DeployScope=None, discovery=None) -> list:
+    """
+    :param discovery: SharedDiscovery, when the services are shared by the deploys of several environments
+    """
+    if discovery is not None:
+        return [DescribeService(service_description=x, scope=scope)
+                for x in discovery.describe_services(cluster_list)]
+    describe_service_list = []
     for cluster_name in cluster_list:
         running_service_arn_list = awsutils.list_services(cluster_name)
-        l.extend(awsutils.describe_services(cluster_name, running_service_arn_list))
-    describe_service_list = []
-    for service_description in l:
-        describe = DescribeService(service_description=service_description)
-        describe_service_list.append(describe)
+        for service_description in awsutils.describe_services(cluster_name, running_service_arn_list):
+            describe_service_list.append(DescribeService(service_description=service_description, scope=scope))
     return describe_service_list
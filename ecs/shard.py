@@ -0,0 +1,72 @@
+# coding: utf-8
+import hashlib
+
+import render
+from ecs.classes import ParameterInvalidException
+from ecs.dependency import deploy_names
+from ecs.utils import get_variables, strtobool
+
+
+def parse_shard(shard: str) -> tuple:
+    """
+    :param shard: `i/n`, i from 1 to n
+    :return: (i, n)
+    """
+    try:
+        index, count = [int(x) for x in shard.split('/')]
+    except ValueError:
+        raise ParameterInvalidException("shard `{shard}` must be `i/n`".format(shard=shard))
+    if count < 1 or index < 1 or index > count:
+        raise ParameterInvalidException("shard `{shard}` must be `i/n` with 1 <= i <= n".format(shard=shard))
+    return index, count
+
+
+def get_shard_index(key: str, count: int) -> int:
+    # 実行する環境によらず同じ値になるようにhashで決める
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest(), 16) % count + 1
+
+
+def select_shard_entries(services_config: dict, environment_config: dict, is_task_definition_config_env: bool,
+                         shard: tuple) -> set:
+    """
+    Services and scheduled tasks of the shard, without rendering their task definitions.
+    Services of a cluster with a primaryPlacement service stay in one shard so they keep their order,
+    the others are spread by name.
+    :param shard: (i, n)
+    :return: set of (deploy_name, name)
+    """
+    index, count = shard
+    clusters = {}
+    primary_clusters = set()
+    for deploy_name in deploy_names:
+        for name, base_config in (services_config.get(deploy_name) or {}).items():
+            config, variables = get_variables(
+                deploy_name=deploy_name,
+                name=name,
+                base_service_config=base_config,
+                environment_config=environment_config,
+                is_task_definition_config_env=is_task_definition_config_env
+            )
+            cluster = config.get('cluster')
+            if cluster is not None:
+                cluster = render.render_template(str(cluster), variables, is_task_definition_config_env)
+            clusters[(deploy_name, name)] = cluster
+            primary_placement = config.get('primaryPlacement')
+            if deploy_name == 'services' and primary_placement is not None:
+                primary_placement = render.render_template(str(primary_placement), variables,
+                                                           is_task_definition_config_env)
+                try:
+                    if bool(strtobool(primary_placement)):
+                        primary_clusters.add(cluster)
+                except ValueError:
+                    raise ParameterInvalidException("Service `{name}` parameter `primaryPlacement` must be bool"
+                                                    .format(name=name))
+    selected = set()
+    for (deploy_name, name), cluster in clusters.items():
+        if deploy_name == 'services' and cluster in primary_clusters:
+            key = "cluster/{cluster}".format(cluster=cluster)
+        else:
+            key = "{deploy_name}/{name}".format(deploy_name=deploy_name, name=name)
+        if get_shard_index(key, count) == index:
+            selected.add((deploy_name, name))
+    return selected
@@ -0,0 +1,120 @@
+# coding: utf-8
+import enum
+import time
+
+# service eventのうち、デプロイが進まないことを示すもの
+# クラスタのスケールアウト中にも出るので、続いた時間で判断する
+placement_failure_messages = (
+    'unable to place a task',
+    'unable to consistently start tasks successfully',
+)
+
+
+class StableState(enum.Enum):
+    retry = 0
+    success = 1
+    failure = 2
+
+
+class ServiceStabilityTracker(object):
+    """
+    Judge each describe_services poll of a service while waiting for stable.
+    Succeeds with the same acceptors as the boto3 `services_stable` waiter,
+    and fails fast when the deployment is clearly failing: failed tasks or a failed rollout,
+    and with `placement_failure_timeout`, placement failures without any new running task for that many seconds.
+    """
+    def __init__(self, service_name: str, failed_tasks_threshold: int, placement_failure_timeout: int=0):
+        self.service_name = service_name
+        self.failed_tasks_threshold = failed_tasks_threshold
+        self.placement_failure_timeout = placement_failure_timeout
+        self.diagnostic = None
+
+        self.is_first_poll = True
+        # 待機開始前のeventとfailedTasksは無視する
+        self.seen_event_ids = set()
+        self.origin_failed_tasks = {}
+        self.failure_events = []
+        self.placement_failing_since = None
+        self.primary_running_count = None
+        # 直近のpollで増えた進捗
+        self.progress = []
+        self.rollout = None
+
+    def observe(self, service_description: dict) -> StableState:
+        new_events = self._new_events(service_description.get('events', []))
+        deployments = service_description.get('deployments', [])
+        self.progress = []
+        if self.is_first_poll:
+            for deployment in deployments:
+                self.origin_failed_tasks[deployment.get('id')] = deployment.get('failedTasks', 0)
+            self.is_first_poll = False
+        else:
+            for event in new_events:
+                message = event.get('message', '')
+                self.progress.append(message)
+                if any(x in message for x in placement_failure_messages):
+                    self.failure_events.append(message)
+                    if self.placement_failing_since is None:
+                        self.placement_failing_since = time.time()
+        rollout = ", ".join(
+            "{status} {running:d} running / {pending:d} pending / {desired:d} desired".format(
+                status=x.get('status'), running=x.get('runningCount', 0), pending=x.get('pendingCount', 0),
+                desired=x.get('desiredCount', 0))
+            for x in deployments
+        )
+        if rollout != self.rollout:
+            self.progress.append("deployments: {rollout}".format(rollout=rollout))
+            self.rollout = rollout
+
+        status = service_description.get('status')
+        if status in ('DRAINING', 'INACTIVE'):
+            self.diagnostic = "service status is {status}.".format(status=status)
+            return StableState.failure
+
+        primary = None
+        for deployment in deployments:
+            if deployment.get('status') == 'PRIMARY':
+                primary = deployment
+        if len(deployments) == 1 and service_description.get('runningCount') == service_description.get('desiredCount'):
+            return StableState.success
+        if primary is None:
+            return StableState.retry
+        # タスクが増えていればスケールアウトで置けるようになった
+        if self.primary_running_count is not None and primary.get('runningCount', 0) > self.primary_running_count:
+            self.placement_failing_since = None
+        self.primary_running_count = primary.get('runningCount', 0)
+
+        if primary.get('rolloutState') == 'FAILED':
+            self.diagnostic = "deployment rollout failed: {reason}".format(reason=primary.get('rolloutStateReason'))
+            return StableState.failure
+        if self.failed_tasks_threshold > 0:
+            failed_tasks = primary.get('failedTasks', 0) - self.origin_failed_tasks.get(primary.get('id'), 0)
+            if failed_tasks >= self.failed_tasks_threshold:
+                self.diagnostic = "{failed_tasks:d} tasks failed to start " \
+                                  "({running:d} running / {pending:d} pending / {desired:d} desired)." \
+                    .format(failed_tasks=failed_tasks, running=primary.get('runningCount', 0),
+                            pending=primary.get('pendingCount', 0), desired=primary.get('desiredCount', 0))
+                self._append_failure_events()
+                return StableState.failure
+        if self.placement_failure_timeout > 0 and self.placement_failing_since is not None:
+            seconds = time.time() - self.placement_failing_since
+            if seconds >= self.placement_failure_timeout:
+                self.diagnostic = "tasks cannot be placed or started for {seconds:.0f} seconds.".format(seconds=seconds)
+                self._append_failure_events()
+                return StableState.failure
+        return StableState.retry
+
+    def _new_events(self, events: list) -> list:
+        new_events = []
+        for event in events:
+            if event.get('id') in self.seen_event_ids:
+                continue
+            self.seen_event_ids.add(event.get('id'))
+            new_events.append(event)
+        # describe_servicesのeventsは新しい順
+        new_events.reverse()
+        return new_events
+
+    def _append_failure_events(self):
+        for message in self.failure_events[-3:]:
+            self.diagnostic += "\n    - {message}".format(message=message)
@@ -0,0 +1,132 @@
+# coding: utf-8
+import copy
+import sys
+import time
+import traceback
+from threading import Thread
+
+from aws import get_role_credentials
+from ecs.classes import ParameterInvalidException, ProcessStatus
+from ecs.deploy import DeployManager, get_deploy_list
+from ecs.shard import parse_shard
+from ecs.utils import h1, success, error
+
+
+class DeployTarget(object):
+    """
+    A region, and the role to assume to deploy to another account
+    """
+    def __init__(self, region: str, role_arn: str=None):
+        self.region = region
+        self.role_arn = role_arn
+        self.name = region
+        if role_arn is not None:
+            try:
+                account = role_arn.split(':')[4]
+            except IndexError:
+                raise ParameterInvalidException("target role `{role_arn}` must be an iam role arn"
+                                                .format(role_arn=role_arn))
+            self.name = "{account}/{region}".format(account=account, region=region)
+
+    @staticmethod
+    def parse(value: str) -> 'DeployTarget':
+        """
+        :param value: `region` or `region,role-arn`
+        """
+        region, _, role_arn = value.partition(',')
+        if len(region) == 0:
+            raise ParameterInvalidException("target `{value}` must be `region` or `region,role-arn`"
+                                            .format(value=value))
+        return DeployTarget(region=region, role_arn=role_arn if len(role_arn) > 0 else None)
+
+
+class ManagerDeploy(Thread):
+    """
+    Runs one DeployManager of a deploy to several targets or environments
+    """
+    def __init__(self, name: str, manager: DeployManager, is_dry_run: bool):
+        super().__init__()
+        self.name = name
+        self.manager = manager
+        self.is_dry_run = is_dry_run
+        self.is_failed = False
+        self.seconds = 0
+
+    def run(self):
+        started = time.time()
+        # noinspection PyBroadException
+        try:
+            if self.is_dry_run:
+                self.manager.dry_run()
+            else:
+                self.manager.run()
+        except SystemExit as e:
+            # _result_checkはエラーがあればexitする
+            self.is_failed = e.code not in (None, 0)
+        except Exception:
+            self.is_failed = True
+            error("Unexpected error in `{name}`.\n{traceback}"
+                  .format(name=self.name, traceback=traceback.format_exc()))
+        self.seconds = time.time() - started
+
+
+def run_deploys(threads: list):
+    """
+    Run the deploys concurrently, print a report of all of them and exit 1 if one failed
+    """
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    h1("Step: Deploy Report")
+    is_failed = False
+    for thread in threads:
+        manager = thread.manager
+        failed_list = [x.name for x in manager.all_deploy_target_service_list + manager.deploy_scheduled_task_list
+                       if x.status == ProcessStatus.error]
+        message = "`{name}`: {services:d} service(s), {tasks:d} scheduled task(s), {seconds:.0f}s"\
+            .format(name=thread.name, services=len(manager.all_deploy_target_service_list),
+                    tasks=len(manager.deploy_scheduled_task_list), seconds=thread.seconds)
+        if thread.is_failed or len(failed_list) > 0:
+            is_failed = True
+            error(message + "\n    - failed: {failed}".format(failed=', '.join(failed_list) or 'see the log'))
+        else:
+            success(message)
+    if is_failed:
+        sys.exit(1)
+
+
+def deploy_targets(args):
+    """
+    Render the templates once, then deploy them to every target concurrently.
+    Each target has its own clients, api throttle, workers and deploy state.
+    """
+    targets = [DeployTarget.parse(x) for x in args.target]
+    if len(set([x.name for x in targets])) != len(targets):
+        raise ParameterInvalidException("targets must not be duplicated.")
+    # テンプレートはリージョンによらないので一度だけrenderする
+    rendered = get_deploy_list(
+        services_yaml=args.services_yaml,
+        environment_yaml=args.environment_yaml,
+        task_definition_template_dir=args.task_definition_template_dir,
+        task_definition_config_json=args.task_definition_config_json,
+        task_definition_config_env=args.task_definition_config_env,
+        deploy_service_group=args.deploy_service_group,
+        template_group=args.template_group,
+        is_detach_service_metadata=args.detach_service_metadata,
+        render_cache_dir=args.render_cache_dir,
+        base_services_yaml=args.base_services_yaml,
+        base_environment_yaml=args.base_environment_yaml,
+        shard=parse_shard(args.shard) if args.shard is not None else None
+    )
+    threads = []
+    for target in targets:
+        if target.role_arn is not None:
+            # 引き受けられないroleはデプロイを始める前に止める。期限が近づくとclientが引き受け直す
+            get_role_credentials(access_key=args.key, secret_key=args.secret, region=target.region,
+                                 role_arn=target.role_arn)
+        manager = DeployManager(args, region=target.region, role_arn=target.role_arn,
+                                rendered=copy.deepcopy(rendered), file_suffix='.' + target.name.replace('/', '.'))
+        threads.append(ManagerDeploy(name=target.name, manager=manager, is_dry_run=args.dry_run))
+    run_deploys(threads)
@@ -0,0 +1,73 @@
+# coding: utf-8
+from collections import OrderedDict
+
+from ecs.classes import Deploy, DeployTargetType
+from ecs.utils import task_definition_fingerprint
+
+
+class TaskDefinitionRegistration(Deploy):
+    def __init__(self, task_definition: dict, fingerprint: str):
+        self.task_definition = task_definition
+        self.fingerprint = fingerprint
+        self.family = task_definition.get('family')
+        self.task_definition_arn = None
+        # 同じタスク定義を使うサービスとスケジュールタスク
+        self.deploy_list = []
+
+        super().__init__(self.family, target_type=DeployTargetType.task_definition)
+
+    def set_task_definition_arn(self, task_definition: dict):
+        self.task_definition_arn = task_definition.get('taskDefinitionArn')
+        for deploy in self.deploy_list:
+            deploy.task_definition_arn = self.task_definition_arn
+
+
+def get_task_definition_registration_list(deploy_list: list) -> list:
+    """
+    Group the services and scheduled tasks which need a new revision by task definition fingerprint
+    :param deploy_list: services and scheduled tasks
+    :return: list of TaskDefinitionRegistration, one per unique task definition
+    """
+    registrations = OrderedDict()
+    for deploy in deploy_list:
+        if deploy.task_definition_arn is not None:
+            continue
+        if deploy.is_same_task_definition():
+            continue
+        fingerprint = task_definition_fingerprint(deploy.task_definition)
+        registration = registrations.get(fingerprint)
+        if registration is None:
+            registration = TaskDefinitionRegistration(task_definition=deploy.task_definition, fingerprint=fingerprint)
+            registrations[fingerprint] = registration
+        registration.deploy_list.append(deploy)
+    return list(registrations.values())
+
+
+class TaskDefinitionFamily(object):
+    def __init__(self, family: str, keep_revisions: int):
+        self.family = family
+        self.keep_revisions = keep_revisions
+        # 使用中のリビジョンは残す
+        self.in_use_arn_list = []
+
+    def get_garbage(self, task_definition_arns: list) -> list:
+        """
+        Revisions to deregister
+        :param task_definition_arns: ACTIVE task definition arns, newest revision first
+        :return: list of task definition arn
+        """
+        keep_arns = set(task_definition_arns[:self.keep_revisions])
+        keep_arns.update(self.in_use_arn_list)
+        return [arn for arn in task_definition_arns[self.keep_revisions:] if arn not in keep_arns]
+
+
+def get_task_definition_family_list(deploy_list: list, keep_revisions: int) -> list:
+    families = OrderedDict()
+    for deploy in deploy_list:
+        family = families.get(deploy.family)
+        if family is None:
+            family = TaskDefinitionFamily(family=deploy.family, keep_revisions=keep_revisions)
+            families[deploy.family] = family
+        if deploy.task_definition_arn is not None:
+            family.in_use_arn_list.append(deploy.task_definition_arn)
+    return list(families.values())
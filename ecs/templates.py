@@ -0,0 +1,76 @@
+# coding: utf-8
+import os
+
+import yaml
+import yamlordereddictloader
+
+import render
+import ecs.service
+from ecs.classes import VariableNotFoundException
+from ecs.dependency import DependencyIndex, select_entries
+from ecs.scheduled_tasks import get_scheduled_task_list
+from ecs.utils import h1, success, info
+
+
+def test_templates(args):
+    h1("Step: Check ECS Template")
+    environment = None
+    files = os.listdir(args.environment_yaml_dir)
+    if files is None or len(files) == 0:
+        raise Exception("environment yaml file not found.")
+    services_config = yaml.load(args.services_yaml, Loader=yamlordereddictloader.Loader)
+    base_services_config = None
+    if args.base_services_yaml is not None:
+        base_services_config = yaml.load(args.base_services_yaml, Loader=yamlordereddictloader.Loader)
+    for f in files:
+        file_path = os.path.join(args.environment_yaml_dir, f)
+        if os.path.isfile(file_path):
+            with open(file_path, 'r') as environment_yaml:
+                environment_config = yaml.load(environment_yaml.read(), Loader=yamlordereddictloader.Loader)
+                environment_services_config = services_config
+                # 変更前の設定があれば影響を受けるものだけrenderする
+                if base_services_config is not None or args.base_environment_yaml_dir is not None:
+                    environment_services_config = select_entries(services_config, get_affected(
+                        args, f, services_config, environment_config, base_services_config))
+
+                environment = environment_config.get("environment")
+                if environment is None:
+                    raise VariableNotFoundException("%s requires parameter `environment`." % file_path)
+                environment = render.render_template(
+                    str(environment),
+                    environment_config,
+                    args.task_definition_config_env
+                )
+
+                ecs.service.get_service_list_yaml(
+                    services_config=environment_services_config,
+                    environment_config=environment_config,
+                    is_task_definition_config_env=args.task_definition_config_env,
+                    environment=environment
+                )
+                get_scheduled_task_list(
+                    services_config=environment_services_config,
+                    environment_config=environment_config,
+                    is_task_definition_config_env=args.task_definition_config_env,
+                    environment=environment
+                )
+        success("Template check environment `{environment}` done.".format(environment=environment))
+
+
+def get_affected(args, file_name: str, services_config: dict, environment_config: dict, base_services_config: dict):
+    if base_services_config is None:
+        base_services_config = services_config
+    base_environment_config = environment_config
+    if args.base_environment_yaml_dir is not None:
+        base_file_path = os.path.join(args.base_environment_yaml_dir, file_name)
+        if not os.path.isfile(base_file_path):
+            # 新しい環境はすべてrenderする
+            base_environment_config = {}
+        else:
+            with open(base_file_path, 'r') as base_environment_yaml:
+                base_environment_config = yaml.load(base_environment_yaml.read(), Loader=yamlordereddictloader.Loader)
+    index = DependencyIndex(services_config, environment_config)
+    affected = index.affected(base_services_config, base_environment_config)
+    info("{file_name}: {count} of {total} service(s) and scheduled task(s) are affected by the change."
+         .format(file_name=file_name, count=len(affected), total=len(index.entries)))
+    return affected
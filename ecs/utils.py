@@ -1,4 +1,7 @@
 # coding: utf-8
+import copy
+import hashlib
+import json
 import logging
 import yaml
 import yamlordereddictloader
@@ -22,6 +25,18 @@ def error(x): print("\033[91mx {x}\033[0m\n".format(x=x))
 def info(x): print("  {x}\n".format(x=x))
 
 
+def strtobool(value: str) -> int:
+    """
+    Same as distutils.util.strtobool, without importing distutils (slow to import, removed in Python 3.12)
+    """
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    elif value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    raise ValueError("invalid truth value %r" % (value,))
+
+
 def is_same_container_definition(a: dict, b: dict) -> bool:
     if not len(a) == len(b):
         return False
@@ -46,6 +61,40 @@ def adjust_container_definition(definition: dict):
     return definition
 
 
+def task_definition_fingerprint(task_definition: dict) -> str:
+    """
+    Hash of the task definition parameters sent by register_task_definition
+    :param task_definition: the task definition
+    :return: hex digest
+    """
+    parameters = {
+        'family': task_definition.get('family'),
+        'containerDefinitions': adjust_container_definition(
+            copy.deepcopy(task_definition.get('containerDefinitions'))),
+        'volumes': task_definition.get('volumes', []),
+        'networkMode': task_definition.get('networkMode'),
+        'taskRoleArn': task_definition.get('taskRoleArn'),
+    }
+    data = json.dumps(parameters, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def get_resource_tags(task_environment) -> list:
+    """
+    ECS tags identifying the deploy target, named after the container environment values
+    :param task_environment: TaskEnvironment of a service or scheduled task
+    :return: list of {'key': ..., 'value': ...}
+    """
+    tags = []
+    for key, value in (('ENVIRONMENT', task_environment.environment),
+                       ('CLUSTER_NAME', task_environment.cluster_name),
+                       ('SERVICE_GROUP', task_environment.service_group),
+                       ('TEMPLATE_GROUP', task_environment.template_group)):
+        if value is not None:
+            tags.append({'key': key, 'value': value})
+    return tags
+
+
 def compare_container_definitions(a: dict, b: dict) -> bool:
     seta = set(a.keys())
     setb = set(b.keys())
@@ -3,55 +3,98 @@ import argparse
 import logging
 import sys
 
-from ecs.deploy import DeployManager, test_templates
-
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(levelname)s: %(message)s')
 logging.getLogger("botocore").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
 # Arguments parsing
-def init():
+def init(argv=None):
     parser = argparse.ArgumentParser(description='Deploy Service on ECS')
     subparser = parser.add_subparsers(dest='command')
     subparser.required = True
 
-    service_parser = subparser.add_parser("service")
-    service_parser.add_argument('--key', default="")
-    service_parser.add_argument('--secret', default="")
-    service_parser.add_argument('--region', default='us-east-1')
-    service_parser.add_argument('--task-definition-template-dir')
-    service_parser.add_argument('--task-definition-config-json', type=argparse.FileType('r'))
-    service_parser.add_argument('--services-yaml', type=argparse.FileType('r'))
-    service_parser.add_argument('--environment-yaml', type=argparse.FileType('r'))
+    # service, plan, applyで使う実行時のオプション
+    deploy_parser = argparse.ArgumentParser(add_help=False)
+    deploy_parser.add_argument('--key', default="")
+    deploy_parser.add_argument('--secret', default="")
+    deploy_parser.add_argument('--region', default='us-east-1')
+    deploy_parser.add_argument('--show-diff', default=False, action='store_true')
+    deploy_parser.add_argument('--threads-count', type=int, default=10)
+    deploy_parser.add_argument('--api-concurrency', type=int, default=5)
+    deploy_parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread')
+    deploy_parser.add_argument('--async-concurrency', type=int, default=200)
+    deploy_parser.add_argument('--service-wait-max-attempts', type=int, default=180)
+    deploy_parser.add_argument('--service-wait-delay', type=int, default=5)
+    deploy_parser.add_argument('--adaptive-service-wait', dest='adaptive_service_wait', default=True,
+                               action='store_true')
+    deploy_parser.add_argument('--no-adaptive-service-wait', dest='adaptive_service_wait', default=True,
+                               action='store_false')
+    deploy_parser.add_argument('--service-failed-tasks-threshold', type=int, default=0)
+    deploy_parser.add_argument('--service-placement-failure-timeout', type=int, default=0)
+    deploy_parser.add_argument('--stream-service-events', dest='stream_service_events', default=True,
+                               action='store_true')
+    deploy_parser.add_argument('--no-stream-service-events', dest='stream_service_events', default=True,
+                               action='store_false')
+    deploy_parser.add_argument('--service-zero-keep', dest='service_zero_keep', default=True, action='store_true')
+    deploy_parser.add_argument('--no-service-zero-keep', dest='service_zero_keep', default=True, action='store_false')
+    deploy_parser.add_argument('--task-definition-keep-revisions', type=int, default=0)
+    deploy_parser.add_argument('--deploy-history')
+    deploy_parser.add_argument('--capacity-aware-rollout', default=False, action='store_true')
+    deploy_parser.add_argument('--capacity-wait-timeout', type=int, default=900)
+    deploy_parser.add_argument('--resource-tags', dest='resource_tags', default=False, action='store_true')
+    deploy_parser.add_argument('--no-resource-tags', dest='resource_tags', default=False, action='store_false')
+    deploy_parser.add_argument('--agent-socket')
+
+    # service, planでrenderするときのオプション。applyではplanの値を使う
+    render_parser = argparse.ArgumentParser(add_help=False)
+    render_parser.add_argument('--task-definition-template-dir')
+    render_parser.add_argument('--task-definition-config-json', type=argparse.FileType('r'))
+    render_parser.add_argument('--services-yaml', type=argparse.FileType('r'))
+    render_parser.add_argument('--environment-yaml', dest='environment_yaml_list', type=argparse.FileType('r'),
+                               action='append')
+    render_parser.add_argument('--task-definition-config-env', default=True, action='store_true')
+    render_parser.add_argument('--no-task-definition-config-env', dest='task_definition_config_env', default=True,
+                               action='store_false')
+    render_parser.add_argument('--stop-before-deploy', dest='stop_before_deploy', default=True, action='store_true')
+    render_parser.add_argument('--no-stop-before-deploy', dest='stop_before_deploy',
+                               default=True, action='store_false')
+    render_parser.add_argument('--template-group')
+    render_parser.add_argument('--deploy-service-group')
+    render_parser.add_argument('--delete-unused-service', dest='delete_unused_service', default=True,
+                               action='store_true')
+    render_parser.add_argument('--no-delete-unused-service', dest='delete_unused_service', default=True,
+                               action='store_false')
+    render_parser.add_argument('--service-update-only', dest='service_update_only', default=False, action='store_true')
+    render_parser.add_argument('--task-definition-update-only', dest='task_definition_update_only', default=False,
+                               action='store_true')
+    render_parser.add_argument('--detach-service-metadata', default=False, action='store_true')
+    render_parser.add_argument('--render-cache-dir')
+    render_parser.add_argument('--shard')
+    render_parser.add_argument('--base-services-yaml', type=argparse.FileType('r'))
+    render_parser.add_argument('--base-environment-yaml', type=argparse.FileType('r'))
+
+    service_parser = subparser.add_parser("service", parents=[deploy_parser, render_parser])
     service_parser.add_argument('-t', '--test', default=False, action='store_true')
     service_parser.add_argument('--dry-run', default=False, action='store_true')
+    service_parser.add_argument('--journal-file')
+    service_parser.add_argument('--resume', default=False, action='store_true')
+    service_parser.add_argument('--target', action='append')
+    service_parser.add_argument('--delete-unused-only', default=False, action='store_true')
 
-    service_parser.add_argument('--task-definition-config-env', default=True, action='store_true')
-    service_parser.add_argument('--no-task-definition-config-env', dest='task_definition_config_env', default=True,
-                                action='store_false')
-    service_parser.add_argument('--threads-count', type=int, default=10)
-    service_parser.add_argument('--service-wait-max-attempts', type=int, default=180)
-    service_parser.add_argument('--service-wait-delay', type=int, default=5)
-    service_parser.add_argument('--service-zero-keep', dest='service_zero_keep', default=True, action='store_true')
-    service_parser.add_argument('--no-service-zero-keep', dest='service_zero_keep', default=True, action='store_false')
-    service_parser.add_argument('--stop-before-deploy', dest='stop_before_deploy', default=True, action='store_true')
-    service_parser.add_argument('--no-stop-before-deploy', dest='stop_before_deploy',
-                                default=True, action='store_false')
-    service_parser.add_argument('--template-group')
-    service_parser.add_argument('--deploy-service-group')
-    service_parser.add_argument('--delete-unused-service', dest='delete_unused_service', default=True,
-                                action='store_true')
-    service_parser.add_argument('--no-delete-unused-service', dest='delete_unused_service', default=True,
-                                action='store_false')
-    service_parser.add_argument('--service-update-only', dest='service_update_only', default=False, action='store_true')
-    service_parser.add_argument('--task-definition-update-only', dest='task_definition_update_only', default=False, action='store_true')
+    plan_parser = subparser.add_parser("plan", parents=[deploy_parser, render_parser])
+    plan_parser.add_argument('--plan-file', required=True)
+
+    apply_parser = subparser.add_parser("apply", parents=[deploy_parser])
+    apply_parser.add_argument('--plan-file', required=True)
 
     test_templates_parser = subparser.add_parser("test-templates")
     test_templates_parser.add_argument('--task-definition-template-dir')
     test_templates_parser.add_argument('--task-definition-config-json')
     test_templates_parser.add_argument('--services-yaml', type=argparse.FileType('r'))
     test_templates_parser.add_argument('--environment-yaml-dir')
+    test_templates_parser.add_argument('--base-services-yaml', type=argparse.FileType('r'))
+    test_templates_parser.add_argument('--base-environment-yaml-dir')
     test_templates_parser.add_argument('--task-definition-config-env', default=True, action='store_true')
     test_templates_parser.add_argument('--no-task-definition-config-env', dest='task_definition_config_env',
                                        default=True, action='store_false')
@@ -62,29 +105,91 @@ def init():
     delete_parser.add_argument('--secret', default="")
     delete_parser.add_argument('--region', default='us-east-1')
     delete_parser.add_argument('--threads-count', type=int, default=3)
+    delete_parser.add_argument('--api-concurrency', type=int, default=3)
     delete_parser.add_argument('--service-wait-max-attempts', type=int, default=72)
     delete_parser.add_argument('--service-wait-delay', type=int, default=5)
     delete_parser.add_argument('--force', action='store_true', default=False)
+    delete_parser.add_argument('--agent-socket')
 
-    argp = parser.parse_args()
-    if argp.command == 'service':
+    agent_parser = subparser.add_parser("agent")
+    agent_parser.add_argument('--socket', required=True)
+    agent_parser.add_argument('--cluster-list-ttl', type=int, default=300)
+
+    argp = parser.parse_args(argv)
+    if argp.command in ('service', 'plan'):
         if argp.task_definition_update_only and argp.service_update_only:
             logger.error("Both --service-update-only and --task-definition-update-only cannnot be set.")
             sys.exit(1)
+        # 一つだけなら今まで通りargs.environment_yamlで扱う
+        argp.environment_yaml = argp.environment_yaml_list[0] if argp.environment_yaml_list else None
+    if argp.command == 'plan' and argp.environment_yaml_list is not None and len(argp.environment_yaml_list) > 1:
+        logger.error("Several --environment-yaml are only for deploy and --dry-run.")
+        sys.exit(1)
+    if argp.command == 'service':
+        if argp.resume and argp.journal_file is None:
+            logger.error("--resume requires --journal-file.")
+            sys.exit(1)
+        if argp.shard is not None and argp.delete_unused_only:
+            logger.error("Both --shard and --delete-unused-only cannnot be set.")
+            sys.exit(1)
+        if argp.delete_unused_only and not argp.delete_unused_service:
+            logger.error("Both --delete-unused-only and --no-delete-unused-service cannnot be set.")
+            sys.exit(1)
+        if argp.delete_unused_only and argp.target is not None:
+            logger.error("--target is only for deploy and --dry-run.")
+            sys.exit(1)
+        if argp.environment_yaml_list is not None and len(argp.environment_yaml_list) > 1:
+            if argp.delete_unused_only or argp.target is not None:
+                logger.error("Several --environment-yaml are only for deploy and --dry-run.")
+                sys.exit(1)
+            if argp.services_yaml is None:
+                logger.error("Several --environment-yaml require --services-yaml.")
+                sys.exit(1)
+            if argp.base_environment_yaml is not None:
+                logger.error("Both several --environment-yaml and --base-environment-yaml cannnot be set.")
+                sys.exit(1)
     return argp
 
-if __name__ == '__main__':
-    args = init()
+
+def run(args):
+    # import only what the subcommand uses: ecs.deploy loads boto3
     if args.command == 'test-templates':
+        from ecs.templates import test_templates
         test_templates(args=args)
+    elif args.command == 'service' and args.test:
+        logger.info("test is successful.")
+    elif args.command == 'service' and args.environment_yaml_list is not None and len(args.environment_yaml_list) > 1:
+        from ecs.environments import deploy_environments
+        deploy_environments(args=args)
+    elif args.command == 'service' and args.target is not None:
+        from ecs.targets import deploy_targets
+        deploy_targets(args=args)
     else:
+        from ecs.deploy import DeployManager
         service_manager = DeployManager(args)
         if args.command == 'delete':
             service_manager.delete()
+        elif args.command == 'plan':
+            service_manager.plan()
+        elif args.command == 'apply':
+            service_manager.apply()
         elif args.command == 'service':
-            if args.test:
-                logger.info("test is successful.")
+            if args.delete_unused_only and not args.dry_run:
+                service_manager.delete_unused()
             elif args.dry_run:
                 service_manager.dry_run()
             else:
                 service_manager.run()
+
+
+if __name__ == '__main__':
+    args = init()
+    if args.command == 'agent':
+        from ecs.agent import serve
+        serve(socket_path=args.socket, parse=init, run=run, cluster_list_ttl=args.cluster_list_ttl)
+    elif getattr(args, 'agent_socket', None) is not None:
+        # 引数の解釈と実行はagentで行う
+        from ecs.agent import submit
+        sys.exit(submit(socket_path=args.agent_socket, argv=sys.argv[1:]))
+    else:
+        run(args)
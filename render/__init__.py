@@ -1,5 +1,6 @@
 # coding: utf-8
 import os
+from functools import lru_cache
 
 import jinja2
 import jinja2.loaders
@@ -24,13 +25,21 @@ def parse_env(data_string):
     return data
 
 
+# raises errors for undefined variables
+_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(template):
+    # 同じテンプレートは環境やサービスが違っても一度だけcompileする
+    return _env.from_string(template)
+
+
 def render_template(template, config, is_env):
     context = {}
     context.update(config)
     if is_env:
         context.update(parse_env(os.environ))
 
-    # raises errors for undefined variables
-    env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-    rendered = env.from_string(template).render(context)
+    rendered = compile_template(template).render(context)
     return rendered